@@ -0,0 +1,318 @@
+"""
+Offline load test of the real dispatcher.
+
+Drives main.dp with synthetic updates for the full lead funnel and the
+full calculator funnel. Telegram is a local stub Bot API server and
+gspread is replaced by in-memory worksheets, so nothing leaves the host.
+
+    python -m bench.loadtest --users 500 --concurrency 100
+    python -m bench.loadtest --api-latency 50 --real-limits
+
+Reports updates/s, p50/p99 update latency, memory per open session and
+the speed of a broadcast to every user the funnels registered.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+
+BOT_TOKEN   = '123456:BENCH'
+GROUP_CHAT  = -100500
+BASE_USER   = 10_000_000
+
+
+# ============================================================
+# Stub Bot API server
+# ============================================================
+class StubTelegram:
+    """Answers every Bot API method with a plausible result."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls   = {}
+        self.blocked = set()
+        self._ids    = itertools.count(1)
+        self._runner = None
+        self.base    = None
+
+    async def handle(self, request):
+        method = request.match_info['method'].lower()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ('sendmessage', 'senddocument'):
+            chat_id = int(data.get('chat_id', 0))
+            if chat_id in self.blocked:
+                return web.json_response({'ok': False, 'error_code': 403,
+                                          'description': 'Forbidden: bot was blocked by the user'}, status=403)
+            result = {
+                'message_id': next(self._ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private'},
+                'text': data.get('text', ''),
+            }
+            if method == 'senddocument':
+                result['document'] = {'file_id': f"doc{result['message_id']}", 'file_unique_id': 'u'}
+        elif method == 'getme':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'getwebhookinfo':
+            result = {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+# ============================================================
+# In-memory gspread stand-in
+# ============================================================
+class FakeWorksheet:
+    def __init__(self, title):
+        self.title = title
+        self.rows  = []
+
+    def append_row(self, row, **kwargs):
+        return self.append_rows([row])
+
+    def append_rows(self, rows, **kwargs):
+        first = len(self.rows) + 1
+        self.rows.extend(list(r) for r in rows)
+        return {'updates': {'updatedRange': f"'{self.title}'!A{first}:Z{len(self.rows)}"}}
+
+    def get(self, rng, **kwargs):
+        start, end = (int(''.join(ch for ch in part if ch.isdigit())) for part in rng.split(':'))
+        return self.rows[start - 1:end]
+
+    def col_values(self, col, **kwargs):
+        return [row[col - 1] if len(row) >= col else '' for row in self.rows]
+
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.sheets = {}
+
+    def worksheet(self, title):
+        return self.sheets.setdefault(title, FakeWorksheet(title))
+
+    def add_worksheet(self, title, rows=0, cols=0):
+        return self.worksheet(title)
+
+
+class FakeClient:
+    def __init__(self):
+        self.spreadsheet = FakeSpreadsheet()
+
+    def open_by_key(self, key):
+        return self.spreadsheet
+
+
+# ============================================================
+# Synthetic updates
+# ============================================================
+_update_ids = itertools.count(1)
+
+
+def _user(uid):
+    return {'id': uid, 'is_bot': False, 'first_name': f"User{uid}", 'username': f"user{uid}"}
+
+
+def text_update(uid, text):
+    message = {
+        'message_id': next(_update_ids), 'date': int(time.time()),
+        'chat': {'id': uid, 'type': 'private'}, 'from': _user(uid), 'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def callback_update(uid, data):
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)), 'from': _user(uid), 'chat_instance': str(uid), 'data': data,
+            'message': {'message_id': next(_update_ids), 'date': int(time.time()), 'chat': {'id': uid, 'type': 'private'}},
+        },
+    }
+
+
+def lead_funnel(uid):
+    return [
+        text_update(uid, '/start'),
+        callback_update(uid, 'lang_ru'),
+        text_update(uid, f"Тестовый Пользователь {uid}"),
+        text_update(uid, f"+99890{uid % 10_000_000:07d}"),
+        text_update(uid, f"Компания {uid}"),
+        callback_update(uid, 'tariff_business'),
+    ]
+
+
+def calc_funnel(uid):
+    return [
+        callback_update(uid, 'calc_ru'),
+        text_update(uid, '10'),
+        text_update(uid, '5000000'),
+        text_update(uid, '150'),
+        text_update(uid, '22'),
+        text_update(uid, '30'),
+        text_update(uid, '15'),
+        callback_update(uid, 'calc_sweep'),
+    ]
+
+
+# ============================================================
+# Runner
+# ============================================================
+async def drive(main, types, updates, latencies):
+    for data in updates:
+        update = types.Update(**data)
+        started = time.perf_counter()
+        await main.dp.updates_handler.notify(update)
+        latencies.append(time.perf_counter() - started)
+
+
+async def run_funnels(main, types, users, concurrency, funnel):
+    latencies = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        uid = BASE_USER + i
+        updates = []
+        if funnel in ('lead', 'both'):
+            updates += lead_funnel(uid)
+        if funnel in ('calc', 'both'):
+            updates += calc_funnel(uid)
+        async with sem:
+            await drive(main, types, updates, latencies)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(users)))
+    return latencies, time.perf_counter() - started
+
+
+async def session_memory(main, types, sessions):
+    """Bytes held per user stuck in the middle of the lead form."""
+    offset = BASE_USER * 2
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(sessions):
+        uid = offset + i
+        for data in lead_funnel(uid)[:4]:
+            await main.dp.updates_handler.notify(types.Update(**data))
+    if hasattr(main.storage, 'flush'):
+        main.storage.flush()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    grown = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return grown / sessions
+
+
+async def run_broadcast(main, stub, blocked_share=0.1):
+    """Broadcast to every registered user; a share of them has blocked the bot."""
+    ids = main.users.page(0, main.users.count())
+    step = int(1 / blocked_share) if blocked_share else 0
+    stub.blocked = set(ids[::step]) if step else set()
+    started = time.perf_counter()
+    cid = main.broadcaster.create(0, "Новые тарифы TripleA")
+    await main.broadcaster.join(cid)
+    elapsed = time.perf_counter() - started
+    return main.broadcaster.campaign(cid), elapsed, len(ids), main.users.count()
+
+
+def pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def main_async(args):
+    stub = StubTelegram(latency=args.api_latency / 1000.0)
+    await stub.start()
+
+    workdir = tempfile.mkdtemp(prefix='triplea-bench-')
+    os.environ.update({
+        'BOT_TOKEN':     BOT_TOKEN,
+        'GROUP_CHAT_ID': str(GROUP_CHAT),
+        'SPREADSHEET_ID': 'bench',
+        'FSM_STORAGE':   args.storage,
+        'FSM_DB_PATH':   os.path.join(workdir, 'fsm.sqlite3'),
+        'OUTBOX_PATH':   os.path.join(workdir, 'outbox.jsonl'),
+        'READMODEL_PATH': os.path.join(workdir, 'readmodel.sqlite3'),
+        'BROADCAST_DB_PATH': os.path.join(workdir, 'broadcast.sqlite3'),
+    })
+    if not args.real_limits:
+        # по умолчанию меряем сам бот, а не ожидание в лимитах Telegram
+        os.environ.update({'TG_GLOBAL_RATE': '1000000', 'TG_CHAT_RATE': '1000000',
+                           'TG_GROUP_PER_MIN': '60000000', 'BROADCAST_RATE': '1000000'})
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+    from aiogram import Bot, Dispatcher, types
+    from aiogram.bot.api import TelegramAPIServer
+
+    main.bot.server = TelegramAPIServer.from_base(stub.base)
+    fake = FakeClient()
+    main.spreadsheet.client_factory = lambda: fake
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    await main.start_services()
+
+    # прогрев: импорт, первые соединения, открытие листов
+    await run_funnels(main, types, 5, 5, args.funnel)
+
+    latencies, elapsed = await run_funnels(main, types, args.users, args.concurrency, args.funnel)
+    per_session = await session_memory(main, types, args.sessions)
+    campaign, bc_elapsed, recipients, registry_left = await run_broadcast(main, stub)
+
+    await main.stop_services()
+    await main.dp.storage.close()
+    await (await main.bot.get_session()).close()
+    await stub.stop()
+
+    leads = len(fake.spreadsheet.sheets.get(main.WORKSHEET_NAME, FakeWorksheet('')).rows)
+    calcs = len(fake.spreadsheet.sheets.get(main.CALC_SHEET_NAME, FakeWorksheet('')).rows)
+    print(f"users            {args.users} (concurrency {args.concurrency}, funnel {args.funnel}, "
+          f"storage {args.storage}, api latency {args.api_latency} ms)")
+    print(f"updates          {len(latencies)} in {elapsed:.2f}s -> {len(latencies) / elapsed:.0f} updates/s")
+    print(f"latency p50      {pct(latencies, 0.50) * 1000:.2f} ms")
+    print(f"latency p99      {pct(latencies, 0.99) * 1000:.2f} ms")
+    print(f"latency mean     {statistics.mean(latencies) * 1000:.2f} ms")
+    print(f"memory/session   {per_session / 1024:.2f} KiB ({args.sessions} open sessions)")
+    print(f"broadcast        {recipients} users in {bc_elapsed:.2f}s -> {recipients / bc_elapsed:.0f} msg/s "
+          f"(sent {campaign['sent']}, blocked {campaign['blocked']}, left in registry {registry_left})")
+    print(f"bot api calls    {sum(stub.calls.values())} {dict(sorted(stub.calls.items()))}")
+    print(f"sheet rows       leads {leads}, calc {calcs}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--funnel', choices=('lead', 'calc', 'both'), default='both')
+    parser.add_argument('--storage', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--sessions', type=int, default=2000, help='open sessions for the memory probe')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='stub Bot API latency, ms')
+    parser.add_argument('--real-limits', action='store_true', help='keep Telegram rate limits')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(main_async(parse_args()))
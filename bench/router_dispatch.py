@@ -0,0 +1,79 @@
+"""
+Micro-benchmark: per-update dispatch cost vs number of handlers.
+
+Compares aiogram's linear filter scan (one lambda per button) with
+IndexedRouter on the same callback updates; no network is used.
+
+    python -m bench.router_dispatch
+"""
+import asyncio
+import time
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+from router import IndexedRouter
+
+SIZES  = (10, 50, 200, 1000)
+ROUNDS = 2000
+
+
+async def noop(callback, state=None):
+    pass
+
+
+def callback_update(update_id, data):
+    return types.Update(**{
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'Bench'},
+            'chat_instance': '1',
+            'data': data,
+            'message': {
+                'message_id': 1, 'date': 0,
+                'chat': {'id': 1, 'type': 'private'},
+            },
+        },
+    })
+
+
+def linear_dispatcher(bot, n):
+    dp = Dispatcher(bot, storage=MemoryStorage())
+    for i in range(n):
+        dp.register_callback_query_handler(noop, lambda c, d=f"btn_{i}": c.data == d, state='*')
+    return dp
+
+
+def indexed_dispatcher(bot, n):
+    dp = Dispatcher(bot, storage=MemoryStorage())
+    router = IndexedRouter()
+    for i in range(n):
+        router.callback(data=f"btn_{i}", state='*')(noop)
+    router.setup(dp)
+    return dp
+
+
+async def measure(dp, n):
+    # худший случай для линейного перебора — последняя кнопка
+    update = callback_update(1, f"btn_{n - 1}")
+    for _ in range(100):
+        await dp.process_update(update)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        await dp.process_update(update)
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+async def main():
+    bot = Bot(token='123456:BENCH')
+    Bot.set_current(bot)
+    print(f"{'handlers':>8}  {'linear, us':>10}  {'indexed, us':>11}")
+    for n in SIZES:
+        linear  = await measure(linear_dispatcher(bot, n), n)
+        indexed = await measure(indexed_dispatcher(bot, n), n)
+        print(f"{n:>8}  {linear:>10.1f}  {indexed:>11.1f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from datetime import datetime
+
+from aiogram.utils.exceptions import (BotBlocked, BotKicked, CantInitiateConversation,
+                                      CantTalkWithBots, ChatNotFound, UserDeactivated)
+
+from sender import TokenBucket
+
+# ============================================================
+# User registry
+# ============================================================
+# пользователь больше недостижим — из реестра его убираем
+UNREACHABLE = (BotBlocked, BotKicked, UserDeactivated, CantInitiateConversation,
+               CantTalkWithBots, ChatNotFound)
+
+
+def _connect(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute('PRAGMA busy_timeout=5000')
+    return db
+
+
+class UserRegistry:
+    """
+    Users who ever started the bot or the calculator (SQLite).
+    touch() is write-behind: changes go to disk in one transaction every
+    flush_interval seconds.
+    """
+
+    def __init__(self, path='broadcast.sqlite3', flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db = _connect(path)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                ' user_id INTEGER PRIMARY KEY, lang TEXT, first_seen TEXT NOT NULL, last_seen TEXT NOT NULL)'
+            )
+        self._dirty = {}
+        self._flush_handle = None
+
+    def touch(self, user_id, lang=None):
+        prev = self._dirty.get(user_id)
+        self._dirty[user_id] = lang or prev
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        now = datetime.utcnow().isoformat()
+        with self._db:
+            self._db.executemany(
+                'INSERT INTO users (user_id, lang, first_seen, last_seen) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET '
+                ' lang = COALESCE(excluded.lang, users.lang), last_seen = excluded.last_seen',
+                [(uid, lang, now, now) for uid, lang in dirty.items()]
+            )
+
+    def prune(self, user_ids):
+        """Forget users who blocked the bot or deleted their account."""
+        if not user_ids:
+            return
+        with self._db:
+            self._db.executemany('DELETE FROM users WHERE user_id = ?', [(uid,) for uid in user_ids])
+
+    def page(self, after, limit):
+        """Next limit user ids greater than after, in id order."""
+        self.flush()
+        rows = self._db.execute(
+            'SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (after, limit)
+        ).fetchall()
+        return [uid for uid, in rows]
+
+    def count(self, after=0):
+        self.flush()
+        return self._db.execute('SELECT COUNT(*) FROM users WHERE user_id > ?', (after,)).fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+# ============================================================
+# Resumable broadcasts
+# ============================================================
+class Broadcaster:
+    """
+    Sends a campaign text to every registered user.
+
+    Users go in id order, page by page. After each page the cursor and
+    counters are saved, so a campaign that was running when the process
+    stopped resumes from the last page (at most one page is sent twice).
+    Sends are capped at rate msg/s on top of the SendScheduler limits and
+    are queued behind every interactive message. Users who blocked the bot
+    are pruned from the registry. report(admin_id, text) gets progress
+    every report_interval seconds and at the end.
+    """
+
+    def __init__(self, bot, registry, rate=20, page_size=100, report=None, report_interval=60):
+        self.bot = bot
+        self.registry = registry
+        self.rate = rate
+        self.page_size = page_size
+        self.report = report
+        self.report_interval = report_interval
+        self._db = _connect(registry.path)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS campaigns ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT, admin INTEGER, text TEXT NOT NULL,'
+                ' status TEXT NOT NULL, cursor INTEGER NOT NULL DEFAULT 0,'
+                ' sent INTEGER NOT NULL DEFAULT 0, blocked INTEGER NOT NULL DEFAULT 0,'
+                ' failed INTEGER NOT NULL DEFAULT 0, created TEXT NOT NULL, finished TEXT)'
+            )
+        self._tasks = {}
+        self._speed = {}   # id -> [начало, обработано на момент начала, конец] для msg/s
+
+    # --------------------------------------------------------
+    # campaigns
+    # --------------------------------------------------------
+    def campaign(self, cid):
+        row = self._db.execute(
+            'SELECT id, admin, text, status, cursor, sent, blocked, failed, created, finished '
+            'FROM campaigns WHERE id = ?', (cid,)
+        ).fetchone()
+        if row is None:
+            return None
+        keys = ('id', 'admin', 'text', 'status', 'cursor', 'sent', 'blocked', 'failed', 'created', 'finished')
+        return dict(zip(keys, row))
+
+    def latest(self):
+        row = self._db.execute('SELECT MAX(id) FROM campaigns').fetchone()
+        return self.campaign(row[0]) if row[0] is not None else None
+
+    def create(self, admin_id, text):
+        with self._db:
+            cur = self._db.execute(
+                "INSERT INTO campaigns (admin, text, status, created) VALUES (?, ?, 'running', ?)",
+                (admin_id, text, datetime.utcnow().isoformat())
+            )
+        cid = cur.lastrowid
+        self._spawn(cid)
+        return cid
+
+    def resume(self):
+        """Restart every campaign that was running when the process stopped."""
+        rows = self._db.execute("SELECT id FROM campaigns WHERE status = 'running'").fetchall()
+        for cid, in rows:
+            if cid not in self._tasks:
+                logging.info(f"Broadcast: продолжаем рассылку #{cid}")
+                self._spawn(cid)
+        return len(rows)
+
+    def stop(self, cid):
+        with self._db:
+            self._db.execute("UPDATE campaigns SET status = 'stopped' WHERE id = ? AND status = 'running'", (cid,))
+        task = self._tasks.pop(cid, None)
+        if task is not None:
+            task.cancel()
+
+    def speed(self, cid):
+        """Messages per second of the current run of a campaign."""
+        c = self.campaign(cid)
+        if c is None or cid not in self._speed:
+            return 0.0
+        started, done0, ended = self._speed[cid]
+        elapsed = (ended or time.monotonic()) - started
+        return (c['sent'] + c['blocked'] + c['failed'] - done0) / elapsed if elapsed > 0 else 0.0
+
+    def progress(self, cid):
+        c = self.campaign(cid)
+        done = c['sent'] + c['blocked'] + c['failed']
+        left = self.registry.count(after=c['cursor']) if c['status'] == 'running' else 0
+        return (
+            f"Рассылка #{c['id']} ({c['status']}): обработано {done}, осталось ~{left}, "
+            f"{self.speed(cid):.1f} msg/s\n"
+            f"доставлено {c['sent']}, заблокировали {c['blocked']}, ошибок {c['failed']}"
+        )
+
+    # --------------------------------------------------------
+    # sending
+    # --------------------------------------------------------
+    def _spawn(self, cid):
+        self._tasks[cid] = asyncio.create_task(self._run(cid))
+
+    async def _send_one(self, user_id, text):
+        try:
+            await self.bot.send_broadcast(user_id, text)
+            return 'sent'
+        except UNREACHABLE:
+            return 'blocked'
+        except Exception as e:
+            logging.warning(f"Broadcast: не отправлено {user_id}: {e}")
+            return 'failed'
+
+    async def _send_page(self, bucket, user_ids, text):
+        tasks = []
+        for uid in user_ids:
+            now = time.monotonic()
+            wait = bucket.delay(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                now = time.monotonic()
+            bucket.consume(now)
+            tasks.append(asyncio.create_task(self._send_one(uid, text)))
+        return await asyncio.gather(*tasks)
+
+    def _report(self, cid):
+        c = self.campaign(cid)
+        text = self.progress(cid)
+        logging.info(f"Broadcast: {text}")
+        if self.report is not None and c['admin']:
+            self.report(c['admin'], text)
+
+    async def _run(self, cid):
+        c = self.campaign(cid)
+        bucket = TokenBucket(self.rate, self.rate)
+        self._speed[cid] = [time.monotonic(), c['sent'] + c['blocked'] + c['failed'], None]
+        reported = time.monotonic()
+        try:
+            while True:
+                user_ids = self.registry.page(c['cursor'], self.page_size)
+                if not user_ids:
+                    break
+                results = await self._send_page(bucket, user_ids, c['text'])
+                blocked = [uid for uid, r in zip(user_ids, results) if r == 'blocked']
+                self.registry.prune(blocked)
+                c['cursor'] = user_ids[-1]
+                c['sent']    += results.count('sent')
+                c['blocked'] += len(blocked)
+                c['failed']  += results.count('failed')
+                # чекпойнт после каждой страницы
+                with self._db:
+                    cur = self._db.execute(
+                        "UPDATE campaigns SET cursor = ?, sent = ?, blocked = ?, failed = ? "
+                        "WHERE id = ? AND status = 'running'",
+                        (c['cursor'], c['sent'], c['blocked'], c['failed'], cid)
+                    )
+                if not cur.rowcount:
+                    # остановлена командой, в том числе из другого воркера
+                    logging.info(f"Broadcast: рассылка #{cid} остановлена")
+                    return
+                if time.monotonic() - reported >= self.report_interval:
+                    reported = time.monotonic()
+                    self._report(cid)
+            with self._db:
+                self._db.execute(
+                    "UPDATE campaigns SET status = 'done', finished = ? WHERE id = ? AND status = 'running'",
+                    (datetime.utcnow().isoformat(), cid)
+                )
+            self._report(cid)
+        except Exception as e:
+            logging.exception(f"Broadcast: рассылка #{cid} прервана: {e}")
+        finally:
+            self._speed[cid][2] = time.monotonic()
+            if self._tasks.get(cid) is asyncio.current_task():
+                del self._tasks[cid]
+
+    async def join(self, cid):
+        """Wait until the campaign finishes or is stopped in this process."""
+        task = self._tasks.get(cid)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def close(self):
+        """Stop sending; running campaigns stay 'running' and resume on next start."""
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._db.close()
@@ -0,0 +1,84 @@
+import numpy as np
+
+# ============================================================
+# Vectorised calculator: scenario grids and break-even points
+# ============================================================
+# тарифы TripleA, сум/звонок
+TARIFFS = {'start': 750, 'business': 600, 'corp': 450}
+
+# диапазоны по умолчанию для таблицы сценариев
+SWEEP_OPS   = np.arange(10, 51, 10)
+SWEEP_CALLS = np.arange(120, 201, 20)
+
+
+def calc_cost_grid(ops, salary, calls_per_day, days, tax_pct, hidden_pct):
+    """
+    Batched calc_cost over the full grid of the given inputs.
+    Each argument is a scalar or 1-D array; the result arrays have shape
+    (len(ops), len(salary), len(calls), len(days), len(tax), len(hidden)).
+    Returns base, taxed, total, total_calls, cost_min, cost_full like calc_cost.
+    """
+    ops, salary, calls_per_day, days, tax_pct, hidden_pct = np.ix_(
+        *(np.atleast_1d(np.asarray(a, dtype=np.float64))
+          for a in (ops, salary, calls_per_day, days, tax_pct, hidden_pct))
+    )
+    base   = salary * ops
+    taxed  = base * (1 + tax_pct / 100.0)
+    total  = taxed * (1 + hidden_pct / 100.0)
+    total_calls = np.maximum(ops * calls_per_day * days, 1)
+    cost_min  = taxed / total_calls
+    cost_full = total / total_calls
+    return base, taxed, total, total_calls, cost_min, cost_full
+
+
+def break_even(salary, days, tax_pct, hidden_pct, tariffs=TARIFFS):
+    """
+    Calls per operator per day at which the full in-house cost of a call
+    equals each tariff. Fewer calls than that — TripleA is cheaper.
+    """
+    loaded = np.asarray(salary, dtype=np.float64) * (1 + np.asarray(tax_pct) / 100.0) \
+        * (1 + np.asarray(hidden_pct) / 100.0)
+    return {name: loaded / (price * np.asarray(days, dtype=np.float64))
+            for name, price in tariffs.items()}
+
+
+def sweep_table(salary, days, tax_pct, hidden_pct, lang='ru',
+                ops_range=SWEEP_OPS, calls_range=SWEEP_CALLS):
+    """Sensitivity table text (Markdown) for one salary/days/tax/hidden setup."""
+    _, _, total, _, _, cost_full = calc_cost_grid(
+        ops_range, salary, calls_range, days, tax_pct, hidden_pct
+    )
+    # себестоимость звонка не зависит от числа операторов — берём первую строку
+    per_call = cost_full[0, 0, :, 0, 0, 0]
+    monthly  = total[:, 0, 0, 0, 0, 0]
+    be = break_even(salary, days, tax_pct, hidden_pct)
+
+    def n(x):
+        return f"{int(round(x)):,}".replace(",", " ")
+
+    if lang == 'ru':
+        title = "📈 *Сценарии*\n+N — на сколько ваш звонок дороже тарифа TripleA, сум"
+        head  = "Звонк/д  Себест.  " + "  ".join(f"{p:>5}" for p in TARIFFS.values())
+        ops_head = "Операторов  ФОТ со скрытыми, сум/мес"
+        be_title = "Точка безубыточности (звонков в день на оператора):"
+        be_hint  = "Меньше звонков — TripleA дешевле."
+    else:
+        title = "📈 *Ssenariylar*\n+N — qo‘ng‘irog‘ingiz TripleA tarifidan qancha qimmat, so‘m"
+        head  = "Qo‘ng/k  Narx     " + "  ".join(f"{p:>5}" for p in TARIFFS.values())
+        ops_head = "Operatorlar  Yashirin bilan, so‘m/oy"
+        be_title = "Zararsizlik nuqtasi (operator kuniga qo‘ng‘iroq):"
+        be_hint  = "Kamroq qo‘ng‘iroq — TripleA arzonroq."
+
+    rows = [head]
+    for calls, cost in zip(calls_range, per_call):
+        diffs = "  ".join(f"{int(round(cost - p)):>+5}" for p in TARIFFS.values())
+        rows.append(f"{calls:>7}  {n(cost):>7}  {diffs}")
+    ops_rows = [ops_head] + [f"{ops:>10}  {n(m)}" for ops, m in zip(ops_range, monthly)]
+    be_rows = [f"{price} — {n(be[name])}" for name, price in TARIFFS.items()]
+
+    return (
+        f"{title}\n\n"
+        "```\n" + "\n".join(rows) + "\n```\n"
+        "```\n" + "\n".join(ops_rows) + "\n```\n"
+        f"{be_title}\n" + "\n".join(be_rows) + f"\n\n{be_hint}"
+    )
@@ -0,0 +1,64 @@
+import time
+from collections import OrderedDict
+
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# ============================================================
+# Duplicate updates and idempotency keys
+# ============================================================
+class SeenCache:
+    """
+    Bounded set of recently seen keys. A key is remembered for ttl
+    seconds; above max_entries the oldest ones are dropped. Both the
+    lookup and the expiry of old keys are O(1) per call.
+    """
+
+    def __init__(self, ttl=3600, max_entries=100_000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._keys = OrderedDict()   # key -> время первого появления
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _expire(self, now):
+        # ключи добавляются по времени — старые в начале
+        keys = self._keys
+        while keys:
+            key, first = next(iter(keys.items()))
+            if now - first < self.ttl:
+                break
+            del keys[key]
+
+    def __contains__(self, key):
+        self._expire(time.monotonic())
+        return key in self._keys
+
+    def add(self, key):
+        self._keys[key] = time.monotonic()
+        self._keys.move_to_end(key)
+        if len(self._keys) > self.max_entries:
+            self._keys.popitem(last=False)
+
+    def seen(self, key):
+        """True if key was already seen within ttl; otherwise remember it."""
+        if key in self:
+            return True
+        self.add(key)
+        return False
+
+
+class DuplicateUpdateMiddleware(BaseMiddleware):
+    """Drops updates whose update_id was already processed (webhook redelivery)."""
+
+    def __init__(self, cache, counter=None):
+        super().__init__()
+        self.cache   = cache
+        self.counter = counter
+
+    async def on_pre_process_update(self, update, data):
+        if self.cache.seen(update.update_id):
+            if self.counter is not None:
+                self.counter.inc('update')
+            raise CancelHandler()
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+# ============================================================
+# Group notifications: instant or coalesced into digests
+# ============================================================
+TG_TEXT_LIMIT = 4096
+SEPARATOR = "\n\n— — —\n\n"
+
+
+class GroupDigest:
+    """
+    Posts notifications to the managers' group one by one while they are
+    rare, and coalesces them into one message per window seconds once more
+    than threshold events arrived within the last minute. Single leads are
+    delivered instantly; a burst costs a few messages instead of one per lead.
+
+    send(text) must return a future of the Bot API call; on_sent() of every
+    item is called once the message that carries it was sent, on_failed()
+    if that send failed.
+    threshold=0 turns digests off.
+    """
+
+    def __init__(self, send, threshold=10, window=15.0):
+        self.send = send
+        self.threshold = threshold
+        self.window = window
+        self._events  = deque()   # время событий за последнюю минуту
+        self._pending = []        # (text, on_sent, on_failed) ждут сводки
+        self._handle  = None
+        # счётчики для метрик
+        self.instant  = 0
+        self.digested = 0
+        self.digests  = 0
+
+    def rate(self, now=None):
+        """Events in the last 60 seconds."""
+        now = time.monotonic() if now is None else now
+        while self._events and now - self._events[0] > 60:
+            self._events.popleft()
+        return len(self._events)
+
+    def stats(self):
+        return {'instant': self.instant, 'digested': self.digested, 'digests': self.digests,
+                'pending': len(self._pending)}
+
+    def post(self, text, on_sent=None, on_failed=None):
+        now = time.monotonic()
+        self._events.append(now)
+        if not self._pending and (not self.threshold or self.rate(now) <= self.threshold):
+            self.instant += 1
+            self._deliver(text, [(on_sent, on_failed)])
+            return
+        self._pending.append((text, on_sent, on_failed))
+        if self._handle is None:
+            self._handle = asyncio.get_event_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        """Send everything collected so far as one message (or a few if long)."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self.digested += len(pending)
+        for chunk in self._chunks(pending):
+            self.digests += 1
+            header = f"📦 Сводка: {len(chunk)} событий за {self.window:.0f}с"
+            self._deliver(header + SEPARATOR + SEPARATOR.join(item[0] for item in chunk),
+                          [item[1:] for item in chunk])
+        logging.info(f"Группа: сводка из {len(pending)} уведомлений (за минуту {self.rate()})")
+
+    @staticmethod
+    def _chunks(pending):
+        # не больше лимита Telegram на длину сообщения, с запасом на заголовок
+        chunk, size = [], 0
+        for item in pending:
+            add = len(item[0]) + len(SEPARATOR)
+            if chunk and size + add > TG_TEXT_LIMIT - 100:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(item)
+            size += add
+        if chunk:
+            yield chunk
+
+    def _deliver(self, text, callbacks):
+        try:
+            fut = self.send(text)
+        except Exception as e:
+            logging.error(f"Группа: не удалось отправить уведомление: {e}")
+            fut = asyncio.get_event_loop().create_future()
+            fut.cancel()
+
+        def done(f):
+            ok = not f.cancelled() and f.exception() is None
+            for on_sent, on_failed in callbacks:
+                cb = on_sent if ok else on_failed
+                if cb is not None:
+                    cb()
+        fut.add_done_callback(done)
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,88 @@
+import re
+
+# ============================================================
+# Phone normalisation and repeat-lead index
+# ============================================================
+COUNTRY_CODE = '998'   # Узбекистан
+NATIONAL_LEN = 9       # код оператора + номер
+# коды мобильных операторов и городов Узбекистана — первые две цифры национального номера
+OPERATOR_CODES = {'20', '33', '50', '55', '61', '62', '65', '66', '67', '69', '71', '72', '73',
+                  '74', '75', '76', '77', '79', '88', '90', '91', '93', '94', '95', '97', '98', '99'}
+
+# организационно-правовые формы, которые не отличают одну компанию от другой
+LEGAL_FORMS = {'ооо', 'ooo', 'ип', 'чп', 'ао', 'оао', 'зао', 'mchj', 'xk', 'ok', 'yatt', 'llc', 'ltd', 'inc'}
+
+
+def normalize_phone(text, country=COUNTRY_CODE):
+    """
+    E.164 form ('+998946772399') of a phone typed in any common format:
+    '+998 94 677-23-99', '998946772399', '8 94 677 23 99', '946772399',
+    and '+94 677 23 99' (a '+' before the national number).
+    None if the text does not look like a phone number.
+    """
+    text = str(text or '').strip()
+    digits = ''.join(ch for ch in text if ch.isdigit())
+    if digits.startswith('00'):
+        digits = digits[2:]
+    elif text.startswith('+') and len(digits) == NATIONAL_LEN and digits[:2] in OPERATOR_CODES:
+        # '+94 677 23 99' — плюс перед национальным номером, а не код другой страны
+        digits = country + digits
+    elif not text.startswith('+'):
+        if len(digits) == NATIONAL_LEN:
+            digits = country + digits
+        elif len(digits) == NATIONAL_LEN + 1 and digits.startswith('8'):
+            # старый междугородний префикс 8
+            digits = country + digits[1:]
+    if digits.startswith(country):
+        return '+' + digits if len(digits) == len(country) + NATIONAL_LEN else None
+    # иностранный номер принимаем только с явным '+' или '00'
+    if (text.startswith('+') or text.startswith('00')) and 8 <= len(digits) <= 15:
+        return '+' + digits
+    return None
+
+
+def normalize_company(text):
+    """Company name reduced to lower-case words without quotes and legal form."""
+    words = re.findall(r'\w+', str(text or '').casefold())
+    return ' '.join(w for w in words if w not in LEGAL_FORMS)
+
+
+class LeadIndex:
+    """
+    In-memory hash index of known leads by phone and by company.
+
+    Each key maps to the set of lead timestamps, so adding the same lead
+    twice (once when recorded, once when it comes back from the sheet) is
+    harmless. row is the last read-model row loaded, for incremental load().
+    """
+
+    def __init__(self):
+        self.row = 0
+        self._phones    = {}
+        self._companies = {}
+
+    def __len__(self):
+        return len(self._phones)
+
+    @staticmethod
+    def _put(index, key, ts):
+        if key:
+            index.setdefault(key, set()).add(str(ts))
+
+    def add(self, phone, company, ts):
+        self._put(self._phones, normalize_phone(phone), ts)
+        self._put(self._companies, normalize_company(company), ts)
+
+    def load(self, rows):
+        """Add (row, phone, company, ts) tuples from the read model."""
+        for row, phone, company, ts in rows:
+            self.add(phone, company, ts)
+            self.row = max(self.row, row)
+
+    def lookup(self, phone, company):
+        """(phone hits, company hits); each is (count, last ts) or None."""
+        def hits(index, key):
+            seen = index.get(key) if key else None
+            return (len(seen), max(seen)) if seen else None
+        return (hits(self._phones, normalize_phone(phone)),
+                hits(self._companies, normalize_company(company)))
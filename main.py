@@ -1,17 +1,36 @@
 import os
 import json
+import asyncio
+import glob
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 
-import gspread
+from gspread.utils import convert_credentials
 from oauth2client.service_account import ServiceAccountCredentials
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from aiogram.utils.executor import start_webhook
+from aiogram.utils import executor
+from aiohttp import web
+
+from broadcast import Broadcaster, UserRegistry
+from calc_sweep import sweep_table
+from dedup import DuplicateUpdateMiddleware, SeenCache
+from digest import GroupDigest
+from leadindex import LeadIndex, normalize_phone
+from metrics import Metrics, UpdateMetricsMiddleware
+from outbox import Outbox
+from pdf_report import PdfReports
+from readmodel import TABLES as READMODEL_TABLES, ReadModel
+from router import IndexedRouter
+from sender import ScheduledBot, SendScheduler
+from sheets import GoogleSession, LazySpreadsheet, SheetWriter, SheetsExecutor
+from storage import BoundedMemoryStorage, SQLiteStorage
+from workers import run_worker, serve
 
 # ============================================================
 # Configuration
@@ -22,53 +41,184 @@ SPREADSHEET_ID   = os.getenv('SPREADSHEET_ID')
 WORKSHEET_NAME   = os.getenv('WORKSHEET_NAME', 'Лист1')   # заявки
 CALC_SHEET_NAME  = os.getenv('CALC_WORKSHEET_NAME', 'Calc')
 MANAGER_URL      = os.getenv('MANAGER_URL', 'https://t.me/+998946772399')
+# кому доступна /stats, через запятую
+ADMIN_IDS        = {int(x) for x in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if x}
 
 WEBHOOK_HOST     = os.getenv('WEBHOOK_HOST')  # e.g. https://triplea-bot-5.onrender.com
 WEBHOOK_PATH     = f"/webhook/{API_TOKEN}"
 WEBHOOK_URL      = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
+WEBHOOK_DELETE_ON_SHUTDOWN = os.getenv('WEBHOOK_DELETE_ON_SHUTDOWN', '0') == '1'
 WEBAPP_HOST      = '0.0.0.0'
 WEBAPP_PORT      = int(os.getenv('PORT', 8000))
+WEB_WORKERS      = int(os.getenv('WEB_WORKERS', 1))   # >1 — несколько процессов
+
+TG_GLOBAL_RATE   = float(os.getenv('TG_GLOBAL_RATE', 30))       # msg/s на весь бот
+TG_CHAT_RATE     = float(os.getenv('TG_CHAT_RATE', 1))          # msg/s в личный чат
+TG_GROUP_PER_MIN = int(os.getenv('TG_GROUP_PER_MIN', 20))       # msg/min в группу
+GROUP_DIGEST_THRESHOLD = int(os.getenv('GROUP_DIGEST_THRESHOLD', 10))      # событий/мин, выше — сводки; 0 — выкл
+GROUP_DIGEST_WINDOW    = float(os.getenv('GROUP_DIGEST_WINDOW', 15))       # сек, за которые копится сводка
+
+FSM_STORAGE      = os.getenv('FSM_STORAGE', 'sqlite')   # sqlite | memory
+FSM_DB_PATH      = os.getenv('FSM_DB_PATH', 'fsm.sqlite3')
+FSM_SESSION_TTL  = int(os.getenv('FSM_SESSION_TTL', 24 * 3600))   # сек бездействия
+FSM_MAX_SESSIONS = int(os.getenv('FSM_MAX_SESSIONS', 50_000))
+
+OUTBOX_PATH      = os.getenv('OUTBOX_PATH', 'outbox.jsonl')
+PDF_WORKERS      = int(os.getenv('PDF_WORKERS', 2))
+PDF_CACHE_BYTES  = int(os.getenv('PDF_CACHE_BYTES', 20_000_000))
+READMODEL_PATH   = os.getenv('READMODEL_PATH', 'readmodel.sqlite3')
+READMODEL_SYNC_INTERVAL = int(os.getenv('READMODEL_SYNC_INTERVAL', 300))   # сек между сверками с таблицей
+STATS_TZ         = os.getenv('STATS_TZ', 'Asia/Tashkent')   # граница «сегодня» в /stats
+BROADCAST_DB_PATH = os.getenv('BROADCAST_DB_PATH', 'broadcast.sqlite3')
+BROADCAST_RATE    = float(os.getenv('BROADCAST_RATE', 20))   # msg/s, остальное — живым ответам
+BROADCAST_PAGE    = int(os.getenv('BROADCAST_PAGE', 100))    # получателей между чекпойнтами
+
+SHEETS_BATCH_SIZE     = int(os.getenv('SHEETS_BATCH_SIZE', 50))
+SHEETS_FLUSH_INTERVAL = float(os.getenv('SHEETS_FLUSH_INTERVAL', 2.0))
+SHEETS_CONCURRENCY    = int(os.getenv('SHEETS_CONCURRENCY', 4))
+SHEETS_TIMEOUT        = float(os.getenv('SHEETS_TIMEOUT', 20.0))
+SHEETS_HTTP_POOL      = int(os.getenv('SHEETS_HTTP_POOL', SHEETS_CONCURRENCY))   # keep-alive соединений к Google
+GOOGLE_TOKEN_MARGIN   = int(os.getenv('GOOGLE_TOKEN_MARGIN', 600))   # сек до истечения токена, когда обновляем
+
+DEDUP_TTL         = int(os.getenv('DEDUP_TTL', 3600))          # сек помним update_id и ключи заявок
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', 100_000))
+
+# ============================================================
+# Metrics (/metrics, Prometheus text format)
+# ============================================================
+metrics = Metrics()
+updates_total    = metrics.counter('bot_updates_total', 'Incoming updates by type', 'type')
+handler_seconds  = metrics.histogram('bot_handler_seconds', 'Handler latency, seconds', 'handler')
+handler_errors   = metrics.counter('bot_handler_errors_total', 'Handler exceptions', 'handler')
+telegram_seconds = metrics.histogram('bot_telegram_seconds', 'Bot API call latency, seconds', 'method')
+telegram_errors  = metrics.counter('bot_telegram_errors_total', 'Failed Bot API calls', 'method')
+sheets_seconds   = metrics.histogram('bot_sheets_seconds', 'Google Sheets call latency, seconds', 'call')
+sheets_errors    = metrics.counter('bot_sheets_errors_total', 'Failed Google Sheets calls', 'call')
+duplicates_total = metrics.counter('bot_duplicates_total', 'Dropped duplicate updates and runs', 'kind')
 
 # ============================================================
 # Bot & Dispatcher
 # ============================================================
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+# все исходящие сообщения идут через общий планировщик с лимитами Telegram
+sender = SendScheduler(global_rate=TG_GLOBAL_RATE, chat_rate=TG_CHAT_RATE,
+                       group_per_min=TG_GROUP_PER_MIN)
+bot = ScheduledBot(token=API_TOKEN, scheduler=sender,
+                   observer=metrics.observer(telegram_seconds, telegram_errors))
+# состояние анкет переживает рестарт и доступно нескольким процессам
+if FSM_STORAGE == 'memory':
+    # брошенные анкеты вытесняются по TTL и LRU
+    storage = BoundedMemoryStorage(ttl=FSM_SESSION_TTL, max_entries=FSM_MAX_SESSIONS)
+else:
+    # в памяти держится не больше FSM_MAX_SESSIONS записей, строки старше TTL удаляются
+    storage = SQLiteStorage(FSM_DB_PATH, ttl=FSM_SESSION_TTL, max_cached=FSM_MAX_SESSIONS)
 dp = Dispatcher(bot, storage=storage)
+# обновления раскладываются по хендлерам через словари, а не перебором фильтров
+router = IndexedRouter(observer=metrics.observer(handler_seconds, handler_errors))
+# повторно доставленные Telegram апдейты отбрасываются до хендлеров;
+# в режиме воркеров чат всегда попадает в один процесс, так что кэша на процесс хватает
+seen_updates = SeenCache(ttl=DEDUP_TTL, max_entries=DEDUP_MAX_ENTRIES)
+seen_runs    = SeenCache(ttl=DEDUP_TTL, max_entries=DEDUP_MAX_ENTRIES)
+dp.middleware.setup(DuplicateUpdateMiddleware(seen_updates, duplicates_total))
+dp.middleware.setup(UpdateMetricsMiddleware(updates_total))
 
 # ============================================================
 # Google Sheets setup
 # ============================================================
 SERVICE_CREDENTIALS_JSON = os.getenv('GOOGLE_CREDENTIALS_JSON')
-if SERVICE_CREDENTIALS_JSON:
-    creds_dict = json.loads(SERVICE_CREDENTIALS_JSON)
-    credentials = ServiceAccountCredentials.from_json_keyfile_dict(
-        creds_dict,
-        ['https://spreadsheets.google.com/feeds',
-         'https://www.googleapis.com/auth/drive']
-    )
-else:
-    SERVICE_ACCOUNT_FILE = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'credentials.json')
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        SERVICE_ACCOUNT_FILE,
-        ['https://spreadsheets.google.com/feeds',
-         'https://www.googleapis.com/auth/drive']
-    )
-gc = gspread.authorize(credentials)
-# основной лист для заявок
-sheet_leads = gc.open_by_key(SPREADSHEET_ID).worksheet(WORKSHEET_NAME)
+GOOGLE_SCOPES = ['https://spreadsheets.google.com/feeds',
+                 'https://www.googleapis.com/auth/drive']
+
+def load_google_credentials():
+    """Service account credentials; called lazily on the first Sheets call."""
+    if SERVICE_CREDENTIALS_JSON:
+        creds_dict = json.loads(SERVICE_CREDENTIALS_JSON)
+        credentials = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, GOOGLE_SCOPES)
+    else:
+        SERVICE_ACCOUNT_FILE = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'credentials.json')
+        credentials = ServiceAccountCredentials.from_json_keyfile_name(SERVICE_ACCOUNT_FILE, GOOGLE_SCOPES)
+    # gspread работает с google-auth — конвертируем так же, как gspread.authorize
+    return convert_credentials(credentials)
+
+# одна keep-alive сессия на все вызовы gspread, токен обновляется заранее в фоне
+google_session = GoogleSession(load_google_credentials, pool_size=SHEETS_HTTP_POOL,
+                               timeout=SHEETS_TIMEOUT, refresh_margin=GOOGLE_TOKEN_MARGIN)
 
+# таблица и листы открываются один раз при первой записи, а не при импорте
+spreadsheet = LazySpreadsheet(google_session.client, SPREADSHEET_ID)
+# основной лист для заявок
+spreadsheet.define('leads', WORKSHEET_NAME)
 # лист для калькулятора
-try:
-    sheet_calc = gc.open_by_key(SPREADSHEET_ID).worksheet(CALC_SHEET_NAME)
-except gspread.exceptions.WorksheetNotFound:
-    sh = gc.open_by_key(SPREADSHEET_ID)
-    sheet_calc = sh.add_worksheet(title=CALC_SHEET_NAME, rows=2000, cols=20)
-    sheet_calc.append_row([
-        "timestamp_utc", "user_id", "username", "source",
-        "operators", "salary", "calls_per_day", "work_days",
-        "tax_pct", "hidden_pct", "cost_min", "cost_full"
-    ])
+spreadsheet.define('calc', CALC_SHEET_NAME, rows=2000, cols=20, header=[
+    "timestamp_utc", "user_id", "username", "source",
+    "operators", "salary", "calls_per_day", "work_days",
+    "tax_pct", "hidden_pct", "cost_min", "cost_full", "record_id"
+])
+
+# все вызовы gspread идут через ограниченный пул потоков, а не в event loop
+# ожидание в loop дольше HTTP-таймаута: поток успевает завершиться сам, а не висит после отмены
+sheets_executor = SheetsExecutor(max_workers=SHEETS_CONCURRENCY, timeout=SHEETS_TIMEOUT + 5,
+                                 observer=metrics.observer(sheets_seconds, sheets_errors))
+
+# локальная копия листов для /stats: свои строки — сразу после записи,
+# чужие — сверкой с таблицей начиная с последней синхронизированной строки
+read_model = ReadModel(sheets_executor, READMODEL_PATH, sync_interval=READMODEL_SYNC_INTERVAL)
+read_model.register('leads', lambda: spreadsheet.worksheet('leads'))
+read_model.register('calc', lambda: spreadsheet.worksheet('calc'))
+# телефоны и компании прошлых заявок — чтобы помечать повторы без чтения таблицы
+lead_index = LeadIndex()
+
+# строки копятся в очереди и уходят пачками через append_rows
+sheet_writer = SheetWriter(
+    executor=sheets_executor,
+    batch_size=SHEETS_BATCH_SIZE,
+    flush_interval=SHEETS_FLUSH_INTERVAL,
+    on_written=read_model.add_rows,
+)
+sheet_writer.register('leads', lambda: spreadsheet.worksheet('leads'))
+sheet_writer.register('calc', lambda: spreadsheet.worksheet('calc'))
+
+# ============================================================
+# Outbox: лид сначала пишется на диск, потом доставляется
+# ============================================================
+outbox = Outbox(OUTBOX_PATH)
+
+# id записи outbox идёт последней колонкой строки — по нему повтор проверяет, что уже записано
+def deliver_to_sheet(rid, payload, ack, fail):
+    sheet_writer.enqueue(payload['sheet'], payload['row'] + [rid], on_done=ack, on_failed=fail)
+
+def _sheet_ids(name):
+    return set(spreadsheet.worksheet(name).col_values(len(READMODEL_TABLES[name]) + 1))
+
+async def sheet_delivered(payloads):
+    """Outbox ids among payloads that are already in their sheets."""
+    present = set()
+    for name in {p['sheet'] for p in payloads.values()}:
+        present |= await sheets_executor.run(_sheet_ids, name)
+    return present
+
+# в группу по одному, а при всплеске заявок — сводками раз в GROUP_DIGEST_WINDOW
+group_digest = GroupDigest(lambda text: bot.notify(GROUP_CHAT_ID, text),
+                           threshold=GROUP_DIGEST_THRESHOLD, window=GROUP_DIGEST_WINDOW)
+
+def deliver_to_group(rid, payload, ack, fail):
+    group_digest.post(f"{payload['text']}\n🔖 {rid[:8]}", on_sent=ack, on_failed=fail)
+
+outbox.register('sheet', deliver_to_sheet, delivered=sheet_delivered)
+if GROUP_CHAT_ID != 0:
+    outbox.register('group', deliver_to_group)
+
+# PDF расчёты рендерятся в отдельных процессах и кешируются
+pdf_reports = PdfReports(max_workers=PDF_WORKERS, max_bytes=PDF_CACHE_BYTES)
+
+# ============================================================
+# Broadcasts: реестр пользователей и рассылки с чекпойнтами
+# ============================================================
+users = UserRegistry(BROADCAST_DB_PATH)
+broadcaster = Broadcaster(bot, users, rate=BROADCAST_RATE, page_size=BROADCAST_PAGE,
+                          report=lambda admin_id, text: bot.notify(admin_id, text))
+# фоновые задачи на всю базу (сверка с таблицей, рассылки) — только в одном процессе
+primary = True
+worker_count = 1
 
 # ============================================================
 # Utility helpers
@@ -104,30 +254,66 @@ def calc_cost(ops, salary, calls_per_day, days, tax_pct, hidden_pct):
     return base, taxed, total, total_calls, cost_min, cost_full
 
 async def log_calc_result(source, user: types.User, data, cost_min, cost_full):
-    """Append calculator data to Google Sheet."""
-    try:
-        sheet_calc.append_row([
-            datetime.utcnow().isoformat(),
-            user.id,
-            f"@{user.username}" if user.username else "",
-            source,
-            data.get('ops'),
-            data.get('salary'),
-            data.get('calls'),
-            data.get('days'),
-            data.get('tax'),
-            data.get('hidden'),
-            cost_min,
-            cost_full
-        ])
-    except Exception as e:
-        logging.error(f"Ошибка записи калькулятора в Google Sheets: {e}")
-
-async def log_lead_to_sheet(name, phone, company, tariff, lang):
-    try:
-        sheet_leads.append_row([name, phone, company, tariff, lang, datetime.utcnow().isoformat()])
-    except Exception as e:
-        logging.error(f"Ошибка при записи лида в Google Sheets: {e}")
+    """Journal calculator data and queue it for the Google Sheet."""
+    row = [
+        datetime.utcnow().isoformat(),
+        user.id,
+        f"@{user.username}" if user.username else "",
+        source,
+        data.get('ops'),
+        data.get('salary'),
+        data.get('calls'),
+        data.get('days'),
+        data.get('tax'),
+        data.get('hidden'),
+        cost_min,
+        cost_full
+    ]
+    outbox.submit({'sheet': {'sheet': 'calc', 'row': row}})
+
+def is_repeat_run(kind, chat_id, message_id):
+    """
+    Idempotency key of a completed lead run: the message that finished it.
+    True if this run was already recorded (see mark_run).
+    """
+    if (kind, chat_id, message_id) in seen_runs:
+        duplicates_total.inc(kind)
+        logging.info(f"Повтор {kind} для чата {chat_id} (сообщение {message_id}) пропущен")
+        return True
+    return False
+
+def mark_run(kind, chat_id, message_id):
+    """Remember a run only once it was recorded, so a failed one can be retried."""
+    seen_runs.add((kind, chat_id, message_id))
+
+def refresh_lead_index():
+    """Load leads the read model got since the last call (other workers, hand edits)."""
+    lead_index.load(read_model.leads(after=lead_index.row))
+
+def repeat_lead_note(phone, company):
+    """Warning lines for the group message if the phone or company was seen before."""
+    refresh_lead_index()
+    by_phone, by_company = lead_index.lookup(phone, company)
+    lines = []
+    if by_phone:
+        n, last = by_phone
+        lines.append(f"⚠️ Повтор: с этого телефона уже было заявок: {n} (последняя {last[:10]})")
+    if by_company:
+        n, last = by_company
+        lines.append(f"⚠️ Компания уже встречалась в заявках: {n} (последняя {last[:10]})")
+    return lines
+
+async def record_lead(user_id, name, phone, company, tariff, lang, group_text):
+    """Journal the lead, then deliver it to the leads sheet and the group chat."""
+    ts = datetime.utcnow().isoformat()
+    row = [name, phone, company, tariff, lang, ts, user_id]
+    lead_index.add(phone, company, ts)
+    targets = {
+        'sheet': {'sheet': 'leads', 'row': row},
+    }
+    if GROUP_CHAT_ID != 0:
+        targets['group'] = {'text': group_text}
+    outbox.submit(targets)
 
 # ============================================================
 # FSM States: Lead Capture
@@ -155,8 +341,9 @@ class CalcForm(StatesGroup):
 # ============================================================
 # Start command
 # ============================================================
-@dp.message_handler(commands=['start'], state='*')
+@router.message(commands=['start'], state='*')
 async def cmd_start(message: types.Message, state: FSMContext):
+    users.touch(message.from_user.id)
     # стартовое меню: язык + калькулятор
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
@@ -181,11 +368,12 @@ async def cmd_start(message: types.Message, state: FSMContext):
 # ============================================================
 # Language selection
 # ============================================================
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith('lang_'), state=Form.lang)
+@router.callback(prefix='lang_', state=Form.lang)
 async def process_lang(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     lang = callback.data.split('_')[1]
     await state.update_data(lang=lang)
+    users.touch(callback.from_user.id, lang)
     if lang == 'ru':
         await bot.send_message(callback.from_user.id, "Введите ваше ФИО:")
     else:
@@ -195,7 +383,7 @@ async def process_lang(callback: CallbackQuery, state: FSMContext):
 # ============================================================
 # Lead capture steps
 # ============================================================
-@dp.message_handler(state=Form.name)
+@router.message(state=Form.name)
 async def process_name(message: types.Message, state: FSMContext):
     await state.update_data(name=message.text)
     data = await state.get_data()
@@ -205,17 +393,25 @@ async def process_name(message: types.Message, state: FSMContext):
         await message.answer("Telefon raqamingizni kiriting:")
     await Form.phone.set()
 
-@dp.message_handler(state=Form.phone)
+@router.message(state=Form.phone)
 async def process_phone(message: types.Message, state: FSMContext):
-    await state.update_data(phone=message.text)
     data = await state.get_data()
+    # храним в E.164, чтобы один номер в разной записи был одним ключом
+    phone = normalize_phone(message.text)
+    if phone is None:
+        if data.get('lang') == 'ru':
+            await message.answer("Не похоже на номер телефона. Введите в формате +998 XX XXX-XX-XX:")
+        else:
+            await message.answer("Telefon raqami noto‘g‘ri. +998 XX XXX-XX-XX formatida kiriting:")
+        return
+    await state.update_data(phone=phone)
     if data.get('lang') == 'ru':
         await message.answer("Введите название вашей компании:")
     else:
         await message.answer("Kompaniyangiz nomini yozing:")
     await Form.company.set()
 
-@dp.message_handler(state=Form.company)
+@router.message(state=Form.company)
 async def process_company(message: types.Message, state: FSMContext):
     await state.update_data(company=message.text)
     keyboard = InlineKeyboardMarkup(row_width=1)
@@ -234,9 +430,12 @@ async def process_company(message: types.Message, state: FSMContext):
         )
     await Form.tariff.set()
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith('tariff_'), state=Form.tariff)
+@router.callback(prefix='tariff_', state=Form.tariff)
 async def process_tariff(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
+    # повторное нажатие на ту же клавиатуру тарифов — заявка уже записана
+    if is_repeat_run('lead', callback.message.chat.id, callback.message.message_id):
+        return
     tariff = callback.data.split('_', 1)[1]
     data = await state.get_data()
     name    = data.get('name')
@@ -244,7 +443,7 @@ async def process_tariff(callback: CallbackQuery, state: FSMContext):
     company = data.get('company')
     lang    = data.get('lang', 'ru')
 
-    # send to group
+    # текст для группы
     text = (
         f"📥 Новый запрос из бота ({lang})\n"
         f"👤 ФИО: {name}\n"
@@ -252,11 +451,12 @@ async def process_tariff(callback: CallbackQuery, state: FSMContext):
         f"🏢 Компания: {company}\n"
         f"💼 Тариф: {tariff}"
     )
-    if GROUP_CHAT_ID != 0:
-        await bot.send_message(GROUP_CHAT_ID, text)
-
-    # log to sheets
-    await log_lead_to_sheet(name, phone, company, tariff, lang)
+    note = repeat_lead_note(phone, company)
+    if note:
+        text += "\n\n" + "\n".join(note)
+    # outbox: запись на диск, затем группа и таблица в фоне
+    await record_lead(callback.from_user.id, name, phone, company, tariff, lang, group_text=text)
+    mark_run('lead', callback.message.chat.id, callback.message.message_id)
 
     keyboard = InlineKeyboardMarkup().add(
         InlineKeyboardButton("💬 Написать менеджеру", url=MANAGER_URL),
@@ -273,7 +473,7 @@ async def process_tariff(callback: CallbackQuery, state: FSMContext):
 # ============================================================
 # Trigger calculator from callback (start screen)
 # ============================================================
-@dp.callback_query_handler(lambda c: c.data in ('calc_ru', 'calc_uz'), state='*')
+@router.callback(data=('calc_ru', 'calc_uz'), state='*')
 async def calc_from_callback(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     lang = 'ru' if callback.data == 'calc_ru' else 'uz'
@@ -282,14 +482,14 @@ async def calc_from_callback(callback: CallbackQuery, state: FSMContext):
 # ============================================================
 # Trigger calculator from message (/calc or text)
 # ============================================================
-@dp.message_handler(commands=['calc'], state='*')
+@router.message(commands=['calc'], state='*')
 async def calc_cmd(message: types.Message, state: FSMContext):
     # если ранее выбирали язык, возьмём его
     data = await state.get_data()
     lang = data.get('lang', 'ru')
     await start_calc_flow(message.chat.id, lang=lang)
 
-@dp.message_handler(lambda m: m.text and m.text.lower() in ('калькулятор', 'kalkulyator', 'calc', 'calculator'), state='*')
+@router.message(text=('калькулятор', 'kalkulyator', 'calc', 'calculator'), state='*')
 async def calc_text(message: types.Message, state: FSMContext):
     data = await state.get_data()
     lang = data.get('lang', 'ru')
@@ -299,6 +499,7 @@ async def calc_text(message: types.Message, state: FSMContext):
 # Calculator flow functions
 # ============================================================
 async def start_calc_flow(chat_id: int, lang='ru'):
+    users.touch(chat_id, lang)
     # set initial state
     state = dp.current_state(chat=chat_id, user=chat_id)
     await state.set_state(CalcForm.lang)
@@ -310,7 +511,7 @@ async def start_calc_flow(chat_id: int, lang='ru'):
 
     await CalcForm.ops.set()
 
-@dp.message_handler(state=CalcForm.ops)
+@router.message(state=CalcForm.ops)
 async def calc_ops_handler(message: types.Message, state: FSMContext):
     ops = to_int(message.text, default=1)
     if ops <= 0:
@@ -323,7 +524,7 @@ async def calc_ops_handler(message: types.Message, state: FSMContext):
         await message.answer("Bitta operator maoshi (so‘m/oy)? (bozorda ~5 000 000)")
     await CalcForm.salary.set()
 
-@dp.message_handler(state=CalcForm.salary)
+@router.message(state=CalcForm.salary)
 async def calc_salary_handler(message: types.Message, state: FSMContext):
     salary = to_int(message.text, default=5_000_000)
     if salary < 1_000_000:
@@ -338,7 +539,7 @@ async def calc_salary_handler(message: types.Message, state: FSMContext):
         await message.answer("Kuniga nechta qo‘ng‘iroq? (tavsiya 150)")
     await CalcForm.calls.set()
 
-@dp.message_handler(state=CalcForm.calls)
+@router.message(state=CalcForm.calls)
 async def calc_calls_handler(message: types.Message, state: FSMContext):
     calls = to_int(message.text, default=150)
     if calls <= 0:
@@ -351,7 +552,7 @@ async def calc_calls_handler(message: types.Message, state: FSMContext):
         await message.answer("Oydagi ish kunlari soni? (22 default)")
     await CalcForm.days.set()
 
-@dp.message_handler(state=CalcForm.days)
+@router.message(state=CalcForm.days)
 async def calc_days_handler(message: types.Message, state: FSMContext):
     days = to_int(message.text, default=22)
     if days <= 0 or days > 31:
@@ -364,7 +565,7 @@ async def calc_days_handler(message: types.Message, state: FSMContext):
         await message.answer("Soliqlar + ijtimoiy (%). (30 default)")
     await CalcForm.tax.set()
 
-@dp.message_handler(state=CalcForm.tax)
+@router.message(state=CalcForm.tax)
 async def calc_tax_handler(message: types.Message, state: FSMContext):
     tax = to_int(message.text, default=30)
     if tax < 0: tax = 0
@@ -377,7 +578,7 @@ async def calc_tax_handler(message: types.Message, state: FSMContext):
         await message.answer("Yashirin xarajatlar (% min). (15 tavsiya)")
     await CalcForm.hidden.set()
 
-@dp.message_handler(state=CalcForm.hidden)
+@router.message(state=CalcForm.hidden)
 async def calc_hidden_handler(message: types.Message, state: FSMContext):
     hidden = to_int(message.text, default=15)
     if hidden < 0: hidden = 0
@@ -413,6 +614,7 @@ async def calc_hidden_handler(message: types.Message, state: FSMContext):
             "Хочешь коммерческое предложение или демо?"
         )
         pdf_txt = "Получить PDF расчёт"
+        sweep_txt = "📈 Таблица сценариев"
         mgr_txt = "Связаться с менеджером"
         test_txt = "Тест 1000 звонков"
     else:
@@ -428,11 +630,13 @@ async def calc_hidden_handler(message: types.Message, state: FSMContext):
             "Tijoriy taklif yoki demo kerakmi?"
         )
         pdf_txt  = "PDF hisob"
+        sweep_txt = "📈 Ssenariylar jadvali"
         mgr_txt  = "Menejer bilan bog‘lanish"
         test_txt = "1000 qo‘ng‘iroq test"
 
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton(pdf_txt, callback_data="calc_pdf"))
+    kb.add(InlineKeyboardButton(sweep_txt, callback_data="calc_sweep"))
     kb.add(InlineKeyboardButton(mgr_txt, url=MANAGER_URL))
     kb.add(InlineKeyboardButton(test_txt, callback_data="calc_test1000"))
 
@@ -442,53 +646,275 @@ async def calc_hidden_handler(message: types.Message, state: FSMContext):
 # ============================================================
 # Calculator callback buttons
 # ============================================================
-@dp.callback_query_handler(lambda c: c.data == "calc_pdf", state='*')
+@router.callback(data='calc_pdf', state='*')
 async def calc_pdf_cb(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     data = await state.get_data()
-    # здесь можно генерить PDF и отправлять файл
-    # пока отправим заглушку
-    await bot.send_message(
-        callback.from_user.id,
-        "PDF расчёт готовится. Менеджер отправит вам файл в ближайшее время. "
-        "Если нужно срочно — нажмите кнопку менеджера выше."
+    lang = data.get('lang', 'ru')
+    if not all(k in data for k in ('ops', 'salary', 'calls', 'days', 'tax', 'hidden')):
+        if lang == 'ru':
+            await bot.send_message(callback.from_user.id, "Расчёт не найден — запустите калькулятор заново: /calc")
+        else:
+            await bot.send_message(callback.from_user.id, "Hisob topilmadi — kalkulyatorni qayta ishga tushiring: /calc")
+        return
+    base, taxed, total, total_calls, cost_min, cost_full = calc_cost(
+        ops=data['ops'],
+        salary=data['salary'],
+        calls_per_day=data['calls'],
+        days=data['days'],
+        tax_pct=data['tax'],
+        hidden_pct=data['hidden']
+    )
+    report = {k: data[k] for k in ('ops', 'salary', 'calls', 'days', 'tax', 'hidden')}
+    report.update(taxed=taxed, total=total, total_calls=total_calls,
+                  cost_min=cost_min, cost_full=cost_full)
+    await pdf_reports.send_or_apologize(bot, callback.from_user.id, report, lang)
+
+@router.callback(data='calc_sweep', state='*')
+async def calc_sweep_cb(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    data = await state.get_data()
+    # вся сетка сценариев считается одним векторным проходом
+    txt = sweep_table(
+        salary=data.get('salary', 5_000_000),
+        days=data.get('days', 22),
+        tax_pct=data.get('tax', 30),
+        hidden_pct=data.get('hidden', 15),
+        lang=data.get('lang', 'ru'),
     )
+    await bot.send_message(callback.from_user.id, txt, parse_mode="Markdown")
 
-@dp.callback_query_handler(lambda c: c.data == "calc_test1000", state='*')
+@router.callback(data='calc_test1000', state='*')
 async def calc_test_cb(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     # уведомим группу, что юзер хочет тест
     u = callback.from_user
-    text = f"🚀 Пользователь @{u.username or u.id} запросил *ТЕСТ 1000 звонков* через калькулятор."
+    text = f"🚀 Пользователь @{u.username or u.id} запросил ТЕСТ 1000 звонков через калькулятор."
     if GROUP_CHAT_ID != 0:
-        await bot.send_message(GROUP_CHAT_ID, text, parse_mode="Markdown")
+        group_digest.post(text)
     await bot.send_message(
         callback.from_user.id,
         "Отлично! Мы получили запрос на тест 1000 звонков. Менеджер свяжется с вами."
     )
 
+# ============================================================
+# Admin: /stats по локальной копии листов
+# ============================================================
+@router.message(commands=['stats'], state='*')
+async def cmd_stats(message: types.Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    days = max(1, to_int(message.get_args(), default=7))
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    # в таблице UTC, а «сегодня» — с полуночи по местному времени
+    midnight = datetime.now(ZoneInfo(STATS_TZ)).replace(hour=0, minute=0, second=0, microsecond=0)
+    today  = read_model.lead_stats(midnight.astimezone(timezone.utc).replace(tzinfo=None).isoformat())
+    leads  = read_model.lead_stats((now - timedelta(days=days)).isoformat())
+    calcs  = read_model.calc_stats((now - timedelta(days=days)).isoformat())
+    elapsed = (time.perf_counter() - started) * 1000
+
+    def counts(d):
+        return ", ".join(f"{k}: {n}" for k, n in d.items()) or "—"
+
+    lines = [
+        "📊 Статистика",
+        "",
+        f"Заявок сегодня: {today['total']}",
+        f"Заявок за {days} дн.: {leads['total']}",
+        f"  по тарифам: {counts(leads['tariff'])}",
+        f"  по языкам: {counts(leads['lang'])}",
+        "",
+        f"Расчётов за {days} дн.: {sum(n for n, _, _ in calcs['source'].values())} "
+        f"(пользователей: {calcs['users']})",
+    ]
+    for source, (n, cost_min, cost_full) in calcs['source'].items():
+        lines.append(f"  {source}: {n}, ср. себестоимость {fmt(cost_min or 0)} / {fmt(cost_full or 0)} сум")
+    lines += [
+        "",
+        f"Строк в копии: заявки {read_model.synced('leads')}, калькулятор {read_model.synced('calc')}",
+        f"⏱ {elapsed:.1f} мс",
+    ]
+    # без Markdown: в тарифах и источниках из таблицы может быть что угодно
+    await message.answer("\n".join(lines))
+
+# ============================================================
+# Admin: рассылки
+# ============================================================
+@router.message(commands=['broadcast'], state='*')
+async def cmd_broadcast(message: types.Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    text = message.get_args()
+    if not text:
+        await message.answer("Использование: /broadcast текст рассылки\n"
+                             "Прогресс: /broadcast_status, остановить: /broadcast_stop")
+        return
+    cid = broadcaster.create(message.from_user.id, text)
+    await message.answer(f"Рассылка #{cid} запущена, получателей: {users.count()}")
+
+@router.message(commands=['broadcast_status'], state='*')
+async def cmd_broadcast_status(message: types.Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    c = broadcaster.campaign(to_int(message.get_args())) or broadcaster.latest()
+    if c is None:
+        await message.answer("Рассылок ещё не было")
+        return
+    await message.answer(broadcaster.progress(c['id']))
+
+@router.message(commands=['broadcast_stop'], state='*')
+async def cmd_broadcast_stop(message: types.Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    c = broadcaster.campaign(to_int(message.get_args())) or broadcaster.latest()
+    if c is None or c['status'] != 'running':
+        await message.answer("Нет запущенной рассылки")
+        return
+    broadcaster.stop(c['id'])
+    await message.answer(broadcaster.progress(c['id']))
+
+router.setup(dp)
+
+# очереди и сессии читаются в момент запроса /metrics
+def fsm_states():
+    """Sessions per state; the SQLite table is shared, so only the primary worker reports it."""
+    if isinstance(storage, SQLiteStorage) and not primary:
+        return {}
+    return storage.states_count()
+
+metrics.gauge('bot_fsm_sessions', 'Active FSM sessions by state', 'state', fsm_states)
+# сколько анкет держится в памяти и сколько вытеснено по LRU / удалено по TTL
+metrics.gauge('bot_fsm_memory_sessions', 'FSM sessions held in memory', 'storage',
+              lambda: {FSM_STORAGE: storage.stats()['live']})
+metrics.counter_fn('bot_fsm_dropped_total', 'FSM sessions evicted by LRU or expired by TTL', 'reason',
+                   lambda: {k: v for k, v in storage.stats().items() if k != 'live'})
+metrics.gauge('bot_queue_depth', 'Pending items in internal queues', 'queue', lambda: {
+    'telegram': sender.stats()['queue_depth'],
+    'sheets':   sheet_writer.pending(),
+    'outbox':   outbox.pending(),
+})
+metrics.gauge('bot_group_notifications', 'Group notifications sent instantly or in digests', 'kind',
+              group_digest.stats)
+# переиспользование соединений к Google и состояние токена
+metrics.gauge('bot_google_http', 'Google API connections, requests and token state', 'stat',
+              google_session.stats)
+
+async def metrics_view(request):
+    return web.Response(text=metrics.render(), content_type='text/plain')
+
 # ============================================================
 # Webhook setup
 # ============================================================
+def orphan_journals():
+    """Outbox journals no live process owns: other mode or a larger worker count."""
+    orphans = []
+    for path in glob.glob(glob.escape(OUTBOX_PATH) + '*'):
+        suffix = path[len(OUTBOX_PATH):].lstrip('.')
+        if path == outbox.path or (suffix and not suffix.isdigit()):
+            continue
+        if path == OUTBOX_PATH or int(suffix) >= worker_count or worker_count == 1:
+            orphans.append(path)
+    return orphans
+
+async def start_services():
+    outbox.open()
+    if primary:
+        # журналы после смены WEB_WORKERS — их записи иначе никто не доставит
+        for path in orphan_journals():
+            outbox.adopt(path)
+    # недоставленное до рестарта повторяется в фоне — порт не ждёт Google
+    outbox.start()
+    sheet_writer.start()
+    read_model.start()
+    google_session.start(sheets_executor)
+    refresh_lead_index()
+    logging.info(f"Индекс заявок: телефонов {len(lead_index)}")
+    if primary:
+        # рассылки, прерванные рестартом, продолжаются с последнего чекпойнта
+        broadcaster.resume()
+
+async def stop_services():
+    # дописываем всё, что осталось в очереди
+    await sheet_writer.close()
+    await read_model.close()
+    google_session.close()
+    sheets_executor.shutdown()
+    pdf_reports.shutdown()
+    await broadcaster.close()
+    users.close()
+    # накопленная сводка уходит до остановки планировщика
+    group_digest.close()
+    await sender.close()
+    await outbox.close()
+
+async def set_webhook():
+    # при рестарте контейнера вебхук обычно уже стоит — лишний вызов не нужен
+    info = await bot.get_webhook_info()
+    if info.url != WEBHOOK_URL:
+        # новый адрес — накопленное за простой не обрабатываем (как раньше skip_updates)
+        await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
+        logging.info(f"Webhook set: {WEBHOOK_URL}")
+    else:
+        logging.info(f"Webhook already set: {WEBHOOK_URL}")
+
+async def delete_webhook():
+    logging.info("Shutting down..")
+    # обычный рестарт вебхук не снимает: Telegram придержит апдейты до подъёма
+    if WEBHOOK_DELETE_ON_SHUTDOWN:
+        await bot.delete_webhook()
+
 async def on_startup(dp):
-    await bot.set_webhook(WEBHOOK_URL)
-    logging.info(f"Webhook set: {WEBHOOK_URL}")
+    await start_services()
+    await set_webhook()
 
 async def on_shutdown(dp):
-    logging.info("Shutting down..")
-    await bot.delete_webhook()
+    await delete_webhook()
+    await stop_services()
+
+# ============================================================
+# Multi-process mode (WEB_WORKERS > 1)
+# ============================================================
+def worker_main(index, workers, queue, stats_queue):
+    """Entry point of one worker process."""
+    global primary, worker_count
+    logging.basicConfig(level=logging.INFO)
+    worker_count = workers
+    # у каждого воркера свой журнал outbox и своя доля общих лимитов Telegram
+    outbox.path = f"{OUTBOX_PATH}.{index}"
+    # сверку с таблицей и рассылки ведёт один воркер, базы общие
+    if index != 0:
+        primary = False
+        read_model.sync_interval = 0
+    sender.share(1 / workers)
+    group_digest.threshold = GROUP_DIGEST_THRESHOLD and max(1, GROUP_DIGEST_THRESHOLD // workers)
+    asyncio.run(run_worker(queue, dp, start_services, stop_services,
+                           index=index, stats_queue=stats_queue, snapshot=metrics.snapshot))
 
 # ============================================================
 # Entrypoint
 # ============================================================
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
-    start_webhook(
-        dispatcher=dp,
-        webhook_path=WEBHOOK_PATH,
-        on_startup=on_startup,
-        on_shutdown=on_shutdown,
-        skip_updates=True,
-        host=WEBAPP_HOST,
-        port=WEBAPP_PORT,
-    )
+    if WEB_WORKERS > 1:
+        # вебхук ставится и снимается один раз — во фронтовом процессе
+        serve(
+            workers=WEB_WORKERS,
+            worker_target=worker_main,
+            webhook_path=WEBHOOK_PATH,
+            host=WEBAPP_HOST,
+            port=WEBAPP_PORT,
+            on_startup=set_webhook,
+            on_shutdown=delete_webhook,
+        )
+    else:
+        app = web.Application()
+        app.router.add_get('/metrics', metrics_view)
+        webhook = executor.set_webhook(
+            dispatcher=dp,
+            webhook_path=WEBHOOK_PATH,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown,
+            web_app=app,
+        )
+        webhook.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)
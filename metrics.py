@@ -0,0 +1,160 @@
+from bisect import bisect_left
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# ============================================================
+# Minimal Prometheus metrics
+# ============================================================
+# границы бакетов гистограмм, секунды
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Series:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum    = 0.0
+        self.count  = 0
+
+
+class HistogramFamily:
+    """Latency histogram with one label; observe() only bumps counters."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, label):
+        self.name, self.help, self.label = name, help, label
+        self.children = {}
+
+    def observe(self, value, seconds):
+        series = self.children.get(value)
+        if series is None:
+            series = self.children[value] = _Series()
+        series.counts[bisect_left(BUCKETS, seconds)] += 1
+        series.sum   += seconds
+        series.count += 1
+
+    def samples(self):
+        return {((self.label, v),): (list(s.counts), s.sum, s.count) for v, s in self.children.items()}
+
+
+class CounterFamily:
+    kind = 'counter'
+
+    def __init__(self, name, help, label):
+        self.name, self.help, self.label = name, help, label
+        self.values = {}
+
+    def inc(self, value, n=1):
+        self.values[value] = self.values.get(value, 0) + n
+
+    def samples(self):
+        return {((self.label, v),): n for v, n in self.values.items()}
+
+
+class GaugeFamily:
+    """Gauge read at scrape time from fn() -> {label value: number}."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, label, fn):
+        self.name, self.help, self.label = name, help, label
+        self.fn = fn
+
+    def samples(self):
+        return {((self.label, v),): n for v, n in self.fn().items()}
+
+
+class CallbackCounterFamily(GaugeFamily):
+    """Counter kept by a component and read at scrape time from fn()."""
+    kind = 'counter'
+
+
+class Metrics:
+    def __init__(self):
+        self.families = []
+
+    def _add(self, family):
+        self.families.append(family)
+        return family
+
+    def histogram(self, name, help, label):
+        return self._add(HistogramFamily(name, help, label))
+
+    def counter(self, name, help, label):
+        return self._add(CounterFamily(name, help, label))
+
+    def gauge(self, name, help, label, fn):
+        return self._add(GaugeFamily(name, help, label, fn))
+
+    def counter_fn(self, name, help, label, fn):
+        return self._add(CallbackCounterFamily(name, help, label, fn))
+
+    @staticmethod
+    def observer(histogram, errors):
+        """Callback (name, seconds, failed) for components that time their calls."""
+        def observe(name, seconds, failed):
+            histogram.observe(name, seconds)
+            if failed:
+                errors.inc(name)
+        return observe
+
+    def snapshot(self):
+        """Picklable {name: (kind, help, samples)}, e.g. to send from a worker."""
+        return {f.name: (f.kind, f.help, f.samples()) for f in self.families}
+
+    def render(self):
+        return render(self.snapshot())
+
+
+def merge(snapshots):
+    """Merge {worker index: snapshot} into one snapshot with a 'worker' label."""
+    merged = {}
+    for index, snap in snapshots.items():
+        for name, (kind, help, samples) in snap.items():
+            target = merged.setdefault(name, (kind, help, {}))[2]
+            for labels, value in samples.items():
+                target[labels + (('worker', str(index)),)] = value
+    return merged
+
+
+def _labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    body = ','.join(f'{k}="{str(v)}"' for k, v in pairs)
+    return '{' + body + '}' if body else ''
+
+
+def render(snapshot):
+    """Prometheus text exposition format."""
+    out = []
+    for name, (kind, help, samples) in snapshot.items():
+        out.append(f"# HELP {name} {help}")
+        out.append(f"# TYPE {name} {kind}")
+        for labels, value in samples.items():
+            if kind == 'histogram':
+                counts, total, count = value
+                acc = 0
+                for le, n in zip(BUCKETS + ('+Inf',), counts):
+                    acc += n
+                    out.append(f"{name}_bucket{_labels(labels, ('le', le))} {acc}")
+                out.append(f"{name}_sum{_labels(labels)} {total}")
+                out.append(f"{name}_count{_labels(labels)} {count}")
+            else:
+                out.append(f"{name}{_labels(labels)} {value}")
+    return '\n'.join(out) + '\n'
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Counts incoming updates by type."""
+
+    def __init__(self, counter):
+        super().__init__()
+        self.counter = counter
+
+    async def on_pre_process_update(self, update, data):
+        if update.message:
+            self.counter.inc('message')
+        elif update.callback_query:
+            self.counter.inc('callback_query')
+        else:
+            self.counter.inc('other')
+
@@ -0,0 +1,267 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import uuid
+
+# ============================================================
+# Durable local outbox
+# ============================================================
+class Outbox:
+    """
+    Append-only JSONL journal of leads and calculator results.
+
+    submit() writes the record to the journal first (buffered write, fsync
+    is batched in the background every fsync_interval seconds) and only
+    then hands every target ('sheet', 'group', ...) to its delivery
+    function. Each delivered target appends an ack line; a target whose
+    delivery failed is retried with exponential backoff, and on startup
+    all records with missing acks are delivered again. Before any
+    redelivery the target's delivered() check drops records that already
+    got through, so a crash between delivery and ack does not duplicate
+    them. The journal is rewritten with only the pending records once it
+    grows past compact_size bytes and doubled since the last rewrite, or
+    every compact_interval seconds if anything was appended. start()
+    replays in the background, so a slow Google does not hold up startup.
+    """
+
+    def __init__(self, path='outbox.jsonl', fsync_interval=0.05, compact_size=1_000_000,
+                 compact_interval=3600, retry_base=5.0, retry_max=600.0):
+        self.path = path
+        self.fsync_interval   = fsync_interval
+        self.compact_size     = compact_size
+        self.compact_interval = compact_interval
+        self.retry_base       = retry_base
+        self.retry_max        = retry_max
+        self._delivery  = {}
+        self._delivered = {}
+        self._pending   = {}     # id -> record с ещё не подтверждёнными целями
+        self._retries   = {}     # (id, target) -> (попытка, когда повторять)
+        self._file      = None
+        self._dirty     = False
+        self._compacted = time.monotonic()
+        self._compacted_size = 0
+        self._task      = None
+        self._retry_task = None
+
+    def register(self, target, deliver, delivered=None):
+        """
+        deliver(rid, payload, ack, fail) must call ack() once the target got
+        the payload, or fail() if it gave up. delivered({rid: payload}) is an
+        optional coroutine returning the set of rids the target already has.
+        """
+        self._delivery[target] = deliver
+        if delivered is not None:
+            self._delivered[target] = delivered
+
+    # --------------------------------------------------------
+    # journal
+    # --------------------------------------------------------
+    def _load(self, path=None):
+        path = path or self.path
+        records = {}
+        if not os.path.exists(path):
+            return records
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # оборванная последняя строка после падения
+                    continue
+                if 'ack' in entry:
+                    rec = records.get(entry['ack'])
+                    if rec is not None:
+                        rec['targets'].pop(entry['target'], None)
+                        if not rec['targets']:
+                            del records[entry['ack']]
+                else:
+                    records[entry['id']] = entry
+        return records
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+        self._dirty = True
+
+    def _rewrite(self):
+        """Replace the journal with the still-pending records only."""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for rec in self._pending.values():
+                f.write(json.dumps(rec, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._compacted = time.monotonic()
+        self._compacted_size = os.path.getsize(self.path)
+
+    def open(self):
+        """Load unfinished records and rewrite the journal with only them."""
+        self._pending = self._load()
+        self._rewrite()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._pending:
+            logging.info(f"Outbox: найдено недоставленных записей: {len(self._pending)}")
+        return list(self._pending.values())
+
+    def adopt(self, path):
+        """
+        Take over the unfinished records of another journal (one no process
+        owns any more) and delete it; they are delivered by the next replay().
+        """
+        records = self._load(path)
+        for rid, rec in records.items():
+            if rid not in self._pending:
+                self._write(rec)
+                self._pending[rid] = rec
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        os.remove(path)
+        if records:
+            logging.info(f"Outbox: из {path} перенесено записей: {len(records)}")
+        return len(records)
+
+    def _compact(self):
+        size = self._file.tell()
+        if size <= self._compacted_size:
+            return
+        # после сжатия в файле остаются все ждущие записи — порог от их размера
+        big = size >= max(self.compact_size, 2 * self._compacted_size)
+        if not big and time.monotonic() - self._compacted < self.compact_interval:
+            return
+        self._file.close()
+        self._rewrite()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._dirty = False
+        logging.info(f"Outbox: журнал сжат ({size} байт), осталось записей: {len(self._pending)}")
+
+    # --------------------------------------------------------
+    # delivery
+    # --------------------------------------------------------
+    def submit(self, targets):
+        """Journal a record {target: payload} and start delivering it."""
+        rec = {'id': uuid.uuid4().hex, 'targets': targets}
+        self._write(rec)
+        self._pending[rec['id']] = rec
+        for target in list(targets):
+            self._deliver(rec, target)
+        return rec['id']
+
+    def _deliver(self, rec, target):
+        deliver = self._delivery.get(target)
+        if deliver is None:
+            # например, группа отключена через GROUP_CHAT_ID=0 — иначе запись висела бы вечно
+            logging.warning(f"Outbox: нет доставки для '{target}', цель записи {rec['id']} отброшена")
+            self.ack(rec['id'], target)
+            return
+        rid = rec['id']
+        deliver(rid, rec['targets'][target], lambda: self.ack(rid, target), lambda: self._failed(rid, target))
+
+    def _failed(self, rid, target):
+        if rid not in self._pending:
+            return
+        attempt = self._retries.get((rid, target), (0, 0))[0]
+        delay = min(self.retry_base * 2 ** attempt, self.retry_max)
+        delay += random.uniform(0, delay / 2)
+        self._retries[(rid, target)] = (attempt + 1, time.monotonic() + delay)
+        logging.warning(f"Outbox: доставка {rid} в '{target}' не удалась, повтор через {delay:.0f}s")
+
+    def ack(self, rid, target):
+        self._retries.pop((rid, target), None)
+        rec = self._pending.get(rid)
+        if rec is None or target not in rec['targets']:
+            return
+        self._write({'ack': rid, 'target': target})
+        del rec['targets'][target]
+        if not rec['targets']:
+            del self._pending[rid]
+
+    async def _redeliver(self, pairs):
+        """Deliver (rec, target) pairs again, skipping what the target already has."""
+        by_target = {}
+        for rec, target in pairs:
+            by_target.setdefault(target, {})[rec['id']] = rec
+        for target, recs in by_target.items():
+            delivered = self._delivered.get(target)
+            if delivered is not None:
+                try:
+                    present = await delivered({rid: rec['targets'][target] for rid, rec in recs.items()})
+                except Exception as e:
+                    logging.error(f"Outbox: не удалось проверить '{target}': {e}")
+                    for rid in recs:
+                        self._failed(rid, target)
+                    continue
+                for rid in present & recs.keys():
+                    logging.info(f"Outbox: {rid} уже есть в '{target}', подтверждаем без повтора")
+                    self.ack(rid, target)
+            for rid, rec in recs.items():
+                if target in rec['targets']:
+                    self._deliver(rec, target)
+
+    async def replay(self):
+        """Deliver again everything that was not acked before the restart."""
+        await self._redeliver([(rec, t) for rec in list(self._pending.values()) for t in rec['targets']])
+
+    async def _retry_due(self):
+        now = time.monotonic()
+        due = [key for key, (_, at) in self._retries.items() if at <= now]
+        pairs = []
+        for rid, target in due:
+            # попытка остаётся в _retries до ack — следующая неудача увеличит паузу
+            self._retries[(rid, target)] = (self._retries[(rid, target)][0], float('inf'))
+            rec = self._pending.get(rid)
+            if rec is not None and target in rec['targets']:
+                pairs.append((rec, target))
+        if pairs:
+            await self._redeliver(pairs)
+
+    def pending(self):
+        return len(self._pending)
+
+    # --------------------------------------------------------
+    # background fsync, retries and compaction
+    # --------------------------------------------------------
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self._retry_task = asyncio.create_task(self._redeliver_loop())
+
+    async def _sync(self):
+        if self._dirty:
+            self._dirty = False
+            await asyncio.to_thread(os.fsync, self._file.fileno())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                await self._sync()
+                self._compact()
+            except Exception as e:
+                logging.error(f"Outbox: ошибка фоновой обработки: {e}")
+
+    async def _redeliver_loop(self):
+        # отдельной задачей: проверка таблицы не должна задерживать fsync новых записей
+        try:
+            await self.replay()
+        except Exception as e:
+            logging.error(f"Outbox: ошибка повторной доставки: {e}")
+        while True:
+            await asyncio.sleep(1)
+            try:
+                await self._retry_due()
+            except Exception as e:
+                logging.error(f"Outbox: ошибка повторной доставки: {e}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._retry_task.cancel()
+            self._task = self._retry_task = None
+        if self._file is not None:
+            await self._sync()
+            self._file.close()
+            self._file = None
@@ -0,0 +1,167 @@
+"""
+Calculator PDF rendering, also the entry point of the renderer processes:
+
+    python pdf_render.py
+
+reads length-prefixed JSON requests on stdin and answers each with a
+status byte and the length-prefixed PDF (or error text) on stdout. It
+imports nothing of the bot, so renderer processes stay small and never
+touch the bot's databases.
+"""
+import io
+import json
+import os
+import struct
+import sys
+
+# ============================================================
+# PDF report for the cost calculator
+# ============================================================
+# шрифт с кириллицей; в Docker ставится пакетом fonts-dejavu-core
+PDF_FONT_PATH = os.getenv('PDF_FONT_PATH', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+
+TEXTS = {
+    'ru': {
+        'title':    "Расчёт себестоимости звонка",
+        'inputs':   "Исходные данные",
+        'ops':      "Операторов",
+        'salary':   "Зарплата оператора, сум/мес",
+        'calls':    "Звонков в день на оператора",
+        'days':     "Рабочих дней в месяце",
+        'tax':      "Налоги и соц. отчисления, %",
+        'hidden':   "Скрытые расходы, %",
+        'result':   "Результат",
+        'taxed':    "ФОТ с налогами, сум/мес",
+        'total':    "Итого со скрытыми, сум/мес",
+        'calls_m':  "Звонков в месяц",
+        'cost_min': "Себестоимость звонка (мин), сум",
+        'cost_full': "Себестоимость звонка (со скрытыми), сум",
+        'compare':  "Сравнение с TripleA",
+        'tariff':   "Тариф",
+        'price':    "Цена звонка, сум",
+        'monthly':  "В месяц, сум",
+        'saving':   "Экономия, сум/мес",
+        'names':    {'start': "Старт", 'business': "Бизнес", 'corp': "Корпоративный"},
+        'caption':  "📄 Ваш расчёт себестоимости",
+        'failed':   "Не удалось подготовить PDF. Результат расчёта — в сообщении выше, попробуйте позже.",
+    },
+    'uz': {
+        'title':    "Qo‘ng‘iroq tannarxi hisobi",
+        'inputs':   "Boshlang‘ich ma’lumotlar",
+        'ops':      "Operatorlar",
+        'salary':   "Operator maoshi, so‘m/oy",
+        'calls':    "Operator kuniga qo‘ng‘iroqlar",
+        'days':     "Oydagi ish kunlari",
+        'tax':      "Soliqlar va ijtimoiy, %",
+        'hidden':   "Yashirin xarajatlar, %",
+        'result':   "Natija",
+        'taxed':    "Soliqlar bilan oylik, so‘m/oy",
+        'total':    "Yashirin bilan jami, so‘m/oy",
+        'calls_m':  "Oydagi qo‘ng‘iroqlar",
+        'cost_min': "Qo‘ng‘iroq narxi (min), so‘m",
+        'cost_full': "Qo‘ng‘iroq narxi (yashirin bilan), so‘m",
+        'compare':  "TripleA bilan solishtirish",
+        'tariff':   "Tarif",
+        'price':    "Qo‘ng‘iroq narxi, so‘m",
+        'monthly':  "Oyiga, so‘m",
+        'saving':   "Tejash, so‘m/oy",
+        'names':    {'start': "Start", 'business': "Biznes", 'corp': "Korporativ"},
+        'caption':  "📄 Hisobingiz",
+        'failed':   "PDF tayyorlab bo‘lmadi. Hisob natijasi yuqoridagi xabarda, keyinroq urinib ko‘ring.",
+    },
+}
+
+
+def _n(num):
+    return f"{int(round(num)):,}".replace(",", " ")
+
+
+def render_calc_pdf(report, lang='ru', tariffs=None):
+    """
+    Render the calculator report to PDF bytes; tariffs is {name: price}.
+    CPU-bound: runs in a renderer process, so imports reportlab lazily.
+    """
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+    if 'Report' not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont('Report', PDF_FONT_PATH))
+
+    t = TEXTS.get(lang, TEXTS['ru'])
+    styles = getSampleStyleSheet()
+    for style in styles.byName.values():
+        style.fontName = 'Report'
+
+    def table(rows):
+        tbl = Table(rows, hAlign='LEFT')
+        tbl.setStyle(TableStyle([
+            ('FONTNAME', (0, 0), (-1, -1), 'Report'),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+            ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+        ]))
+        return tbl
+
+    inputs = [[t[k], _n(report[k])] for k in ('ops', 'salary', 'calls', 'days', 'tax', 'hidden')]
+    result = [
+        [t['taxed'],     _n(report['taxed'])],
+        [t['total'],     _n(report['total'])],
+        [t['calls_m'],   _n(report['total_calls'])],
+        [t['cost_min'],  _n(report['cost_min'])],
+        [t['cost_full'], _n(report['cost_full'])],
+    ]
+    compare = [[t['tariff'], t['price'], t['monthly'], t['saving']]]
+    for name, price in (tariffs or {}).items():
+        monthly = price * report['total_calls']
+        compare.append([t['names'][name], _n(price), _n(monthly), _n(report['total'] - monthly)])
+
+    buf = io.BytesIO()
+    doc = SimpleDocTemplate(buf, pagesize=A4, title=t['title'])
+    doc.build([
+        Paragraph(f"TripleA — {t['title']}", styles['Title']),
+        Spacer(1, 12),
+        Paragraph(t['inputs'], styles['Heading2']), table(inputs),
+        Spacer(1, 12),
+        Paragraph(t['result'], styles['Heading2']), table(result),
+        Spacer(1, 12),
+        Paragraph(t['compare'], styles['Heading2']), table(compare),
+    ])
+    return buf.getvalue()
+
+
+# ============================================================
+# Renderer process
+# ============================================================
+HEADER = struct.Struct('>I')
+OK, FAILED = b'\x00', b'\x01'
+
+
+def _read(stream, n):
+    data = stream.read(n)
+    return data if len(data) == n else None
+
+
+def serve(stdin=None, stdout=None):
+    """Answer render requests until stdin is closed."""
+    stdin = stdin or sys.stdin.buffer
+    stdout = stdout or sys.stdout.buffer
+    while True:
+        header = _read(stdin, HEADER.size)
+        if header is None:
+            return
+        req = json.loads(_read(stdin, HEADER.unpack(header)[0]))
+        try:
+            status, body = OK, render_calc_pdf(req['report'], req['lang'], req['tariffs'])
+        except Exception as e:
+            # например, нет шрифта — процесс остаётся рабочим
+            status, body = FAILED, f"{type(e).__name__}: {e}".encode()
+        stdout.write(status + HEADER.pack(len(body)) + body)
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,161 @@
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+from collections import OrderedDict
+
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import BadRequest
+
+from calc_sweep import TARIFFS
+from pdf_render import FAILED, HEADER, TEXTS
+
+# ============================================================
+# PDF report for the cost calculator
+# ============================================================
+RENDER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdf_render.py')
+
+
+class RenderError(Exception):
+    """The renderer process reported a failure (e.g. the font is missing)."""
+
+
+class _Renderer:
+    """One long-lived `python pdf_render.py` process."""
+
+    def __init__(self, proc):
+        self.proc = proc
+
+    @classmethod
+    async def start(cls):
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, RENDER_SCRIPT,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        return cls(proc)
+
+    async def render(self, report, lang):
+        req = json.dumps({'report': report, 'lang': lang, 'tariffs': TARIFFS}).encode()
+        self.proc.stdin.write(HEADER.pack(len(req)) + req)
+        await self.proc.stdin.drain()
+        status = await self.proc.stdout.readexactly(1)
+        size, = HEADER.unpack(await self.proc.stdout.readexactly(HEADER.size))
+        body = await self.proc.stdout.readexactly(size)
+        if status == FAILED:
+            raise RenderError(body.decode(errors='replace'))
+        return body
+
+    def kill(self):
+        if self.proc.returncode is None:
+            self.proc.kill()
+
+
+class PdfReports:
+    """
+    Renders calculator PDFs in up to max_workers renderer processes
+    (pdf_render.py, started on demand and reused) and caches them by a hash
+    of the report content: Telegram file_ids (reused with one send_document)
+    and rendered bytes, both LRU-evicted, the bytes by total size.
+    A renderer that crashes or exceeds render_timeout is killed and
+    replaced on the next render.
+    """
+
+    def __init__(self, max_workers=2, max_bytes=20_000_000, max_file_ids=10_000, render_timeout=60):
+        self.max_workers  = max_workers
+        self.max_bytes    = max_bytes
+        self.max_file_ids = max_file_ids
+        self.render_timeout = render_timeout
+        self._idle     = []
+        self._slots    = asyncio.Semaphore(max_workers)
+        self._file_ids = OrderedDict()
+        self._pdfs     = OrderedDict()
+        self._size     = 0
+        self._inflight = {}
+
+    @staticmethod
+    def content_key(report, lang):
+        raw = json.dumps([report, lang], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _remember_pdf(self, key, pdf):
+        self._pdfs[key] = pdf
+        self._size += len(pdf)
+        while self._size > self.max_bytes and len(self._pdfs) > 1:
+            _, old = self._pdfs.popitem(last=False)
+            self._size -= len(old)
+
+    def _remember_file_id(self, key, file_id):
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.max_file_ids:
+            self._file_ids.popitem(last=False)
+
+    async def render(self, key, report, lang):
+        pdf = self._pdfs.get(key)
+        if pdf is not None:
+            self._pdfs.move_to_end(key)
+            return pdf
+        # одинаковые запросы, пришедшие одновременно, ждут одного рендера
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._render(report, lang))
+            self._inflight[key] = fut
+            try:
+                pdf = await fut
+                self._remember_pdf(key, pdf)
+            finally:
+                del self._inflight[key]
+            return pdf
+        return await fut
+
+    async def _render(self, report, lang):
+        async with self._slots:
+            # простаивавший процесс мог уже умереть (OOM) — такие пропускаем
+            while self._idle and self._idle[-1].proc.returncode is not None:
+                self._idle.pop()
+            renderer = self._idle.pop() if self._idle else await _Renderer.start()
+            try:
+                pdf = await asyncio.wait_for(renderer.render(report, lang), self.render_timeout)
+            except RenderError:
+                # процесс жив и ответил — пригодится для следующего расчёта
+                self._idle.append(renderer)
+                raise
+            except BaseException:
+                renderer.kill()
+                raise
+            self._idle.append(renderer)
+            return pdf
+
+    async def send_or_apologize(self, bot, chat_id, report, lang='ru'):
+        """send(), but a render or upload failure ends with a short message instead."""
+        try:
+            return await self.send(bot, chat_id, report, lang)
+        except Exception as e:
+            # например, нет шрифта DejaVu или упал процесс рендера
+            logging.error(f"PDF: не удалось отправить расчёт {chat_id}: {e}")
+            return await bot.send_message(chat_id, TEXTS.get(lang, TEXTS['ru'])['failed'])
+
+    async def send(self, bot, chat_id, report, lang='ru'):
+        key = self.content_key(report, lang)
+        t = TEXTS.get(lang, TEXTS['ru'])
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+            try:
+                return await bot.send_document(chat_id, file_id, caption=t['caption'])
+            except BadRequest as e:
+                logging.warning(f"PDF: file_id больше не действует ({e}), рендерим заново")
+                del self._file_ids[key]
+        pdf = await self.render(key, report, lang)
+        doc = InputFile(io.BytesIO(pdf), filename=f"triplea_calc_{key[:8]}.pdf")
+        msg = await bot.send_document(chat_id, doc, caption=t['caption'])
+        self._remember_file_id(key, msg.document.file_id)
+        return msg
+
+    def shutdown(self):
+        idle, self._idle = self._idle, []
+        for renderer in idle:
+            renderer.kill()
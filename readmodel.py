@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import sqlite3
+from datetime import datetime
+
+# ============================================================
+# Local read model of the leads and calc sheets
+# ============================================================
+# колонки листов в том порядке, в каком бот пишет строки
+TABLES = {
+    'leads': ('name', 'phone', 'company', 'tariff', 'lang', 'ts', 'user_id'),
+    'calc':  ('ts', 'user_id', 'username', 'source', 'ops', 'salary', 'calls',
+              'days', 'tax', 'hidden', 'cost_min', 'cost_full'),
+}
+INDEXES = {
+    'leads': ('ts', 'tariff, ts', 'lang, ts', 'user_id'),
+    'calc':  ('ts', 'source, ts', 'user_id'),
+}
+
+
+def _last_column(name):
+    return chr(ord('A') + len(TABLES[name]) - 1)
+
+
+class ReadModel:
+    """
+    SQLite mirror of the leads and calc sheets for admin queries.
+
+    Rows the bot writes are added as soon as SheetWriter reports their
+    sheet row (add_rows). reconcile() reads only the rows past the synced
+    offset of each sheet, which also picks up rows typed in by hand. Rows
+    are keyed by sheet row number, so reading a range twice is harmless.
+    """
+
+    def __init__(self, executor, path='readmodel.sqlite3', sync_interval=300, chunk=2000):
+        self.executor = executor
+        self.path = path
+        self.sync_interval = sync_interval   # 0 — без фоновой сверки
+        self.chunk = chunk
+        self._sources = {}
+        self._task = None
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('PRAGMA busy_timeout=5000')
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (sheet TEXT PRIMARY KEY, synced INTEGER NOT NULL)')
+            for name, cols in TABLES.items():
+                self._db.execute(f"CREATE TABLE IF NOT EXISTS {name} (row INTEGER PRIMARY KEY, {', '.join(cols)})")
+                for i, index in enumerate(INDEXES[name]):
+                    self._db.execute(f"CREATE INDEX IF NOT EXISTS {name}_idx{i} ON {name} ({index})")
+                self._db.execute('INSERT OR IGNORE INTO meta (sheet, synced) VALUES (?, 0)', (name,))
+
+    def register(self, name, open_worksheet):
+        """open_worksheet() returns the gspread worksheet; called in the executor."""
+        self._sources[name] = open_worksheet
+
+    def synced(self, name):
+        """Number of sheet rows already mirrored (the reconcile offset)."""
+        return self._db.execute('SELECT synced FROM meta WHERE sheet = ?', (name,)).fetchone()[0]
+
+    # --------------------------------------------------------
+    # writes
+    # --------------------------------------------------------
+    @staticmethod
+    def _parse(name, values):
+        cols = TABLES[name]
+        values = list(values)[:len(cols)]
+        values += [None] * (len(cols) - len(values))
+        rec = dict(zip(cols, values))
+        try:
+            datetime.fromisoformat(str(rec['ts']))
+        except ValueError:
+            # заголовок, пустая или ручная строка без даты
+            return None
+        return rec
+
+    def add_rows(self, name, first_row, rows):
+        """Upsert rows that start at sheet row first_row."""
+        if first_row is None or name not in TABLES:
+            return
+        cols = TABLES[name]
+        params = []
+        for i, values in enumerate(rows):
+            rec = self._parse(name, values)
+            if rec is not None:
+                params.append((first_row + i, *(rec[c] for c in cols)))
+        last = first_row + len(rows) - 1
+        with self._db:
+            if params:
+                self._db.executemany(
+                    f"INSERT OR REPLACE INTO {name} (row, {', '.join(cols)}) "
+                    f"VALUES ({', '.join('?' * (len(cols) + 1))})",
+                    params
+                )
+            # смещение двигаем, только если новые строки примыкают к уже синхронизированным
+            self._db.execute(
+                'UPDATE meta SET synced = ? WHERE sheet = ? AND synced >= ? AND synced < ?',
+                (last, name, first_row - 1, last)
+            )
+
+    # --------------------------------------------------------
+    # incremental reconcile with the sheets
+    # --------------------------------------------------------
+    def _read_rows(self, name, start):
+        ws = self._sources[name]()
+        rng = f"A{start}:{_last_column(name)}{start + self.chunk - 1}"
+        return ws.get(rng, value_render_option='UNFORMATTED_VALUE')
+
+    async def reconcile(self):
+        """Read every sheet past its synced offset; returns the number of rows read."""
+        total = 0
+        for name in self._sources:
+            while True:
+                start = self.synced(name) + 1
+                values = await self.executor.run(self._read_rows, name, start)
+                if values:
+                    self.add_rows(name, start, values)
+                    total += len(values)
+                if len(values) < self.chunk:
+                    break
+        return total
+
+    async def _run(self):
+        while True:
+            try:
+                n = await self.reconcile()
+                if n:
+                    logging.info(f"ReadModel: подтянуто строк из таблицы: {n}")
+            except Exception as e:
+                logging.error(f"ReadModel: ошибка сверки с таблицей: {e}")
+            await asyncio.sleep(self.sync_interval)
+
+    def start(self):
+        if self._task is None and self.sync_interval:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._db.close()
+
+    # --------------------------------------------------------
+    # queries
+    # --------------------------------------------------------
+    def leads(self, after=0):
+        """(row, phone, company, ts) of leads past sheet row after, up to the synced offset."""
+        return self._db.execute(
+            "SELECT row, phone, company, ts FROM leads WHERE row > ? "
+            "AND row <= (SELECT synced FROM meta WHERE sheet = 'leads') ORDER BY row", (after,)
+        ).fetchall()
+
+    def lead_stats(self, since):
+        """Leads since the ISO timestamp: total, per tariff and per language."""
+        q = self._db.execute
+        return {
+            'total':  q('SELECT COUNT(*) FROM leads WHERE ts >= ?', (since,)).fetchone()[0],
+            'tariff': dict(q('SELECT tariff, COUNT(*) FROM leads WHERE ts >= ? '
+                             'GROUP BY tariff ORDER BY 2 DESC', (since,))),
+            'lang':   dict(q('SELECT lang, COUNT(*) FROM leads WHERE ts >= ? '
+                             'GROUP BY lang ORDER BY 2 DESC', (since,))),
+        }
+
+    def calc_stats(self, since):
+        """Calculator runs since the ISO timestamp: users and per-source averages."""
+        q = self._db.execute
+        return {
+            'users':  q('SELECT COUNT(DISTINCT user_id) FROM calc WHERE ts >= ?', (since,)).fetchone()[0],
+            'source': {src: (n, cost_min, cost_full) for src, n, cost_min, cost_full in q(
+                'SELECT source, COUNT(*), AVG(cost_min), AVG(cost_full) FROM calc WHERE ts >= ? '
+                'GROUP BY source ORDER BY 2 DESC', (since,))},
+        }
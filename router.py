@@ -0,0 +1,128 @@
+import itertools
+import time
+
+from aiogram import types
+from aiogram.dispatcher import FSMContext
+
+# ============================================================
+# Indexed router for callbacks and messages
+# ============================================================
+ANY_STATE = '*'
+
+
+def _state_key(state):
+    """'*', None (no state) or the 'Group:name' string of a State."""
+    if state is None or state == ANY_STATE:
+        return state
+    return getattr(state, 'state', state)
+
+
+class IndexedRouter:
+    """
+    Dispatches updates by dictionary lookups instead of testing every
+    handler filter in turn. Handlers are indexed by (state, key):
+
+    - callbacks: exact callback_data, or prefix up to and including the
+      first '_' (e.g. 'lang_', 'tariff_');
+    - messages: command, lower-cased text, or just the state.
+
+    Among the handlers that match (for the current state or '*'), the one
+    registered first wins, as with aiogram's own handler list: a state
+    handler declared before a '*' command keeps its input.
+    setup(dp) registers one aiogram handler per update type.
+    observer(handler_name, seconds, failed) is called after every handler.
+    """
+
+    def __init__(self, observer=None):
+        self.observer   = observer
+        self._cb_exact  = {}
+        self._cb_prefix = {}
+        self._commands  = {}
+        self._texts     = {}
+        self._states    = {}
+        self._order     = itertools.count()
+
+    # --------------------------------------------------------
+    # registration
+    # --------------------------------------------------------
+    def callback(self, data=None, prefix=None, state=None):
+        def decorator(handler):
+            st = _state_key(state)
+            entry = (next(self._order), handler)
+            if prefix is not None:
+                if not prefix.endswith('_'):
+                    raise ValueError(f"callback prefix must end with '_': {prefix!r}")
+                self._cb_prefix[(st, prefix)] = entry
+            for item in ([data] if isinstance(data, str) else data or ()):
+                self._cb_exact[(st, item)] = entry
+            return handler
+        return decorator
+
+    def message(self, commands=None, text=None, state=None):
+        def decorator(handler):
+            st = _state_key(state)
+            entry = (next(self._order), handler)
+            for cmd in commands or ():
+                self._commands[(st, cmd.lower())] = entry
+            for item in text or ():
+                self._texts[(st, item.lower())] = entry
+            if not commands and not text:
+                self._states[st] = entry
+            return handler
+        return decorator
+
+    def setup(self, dp):
+        dp.register_callback_query_handler(self.dispatch_callback, state=ANY_STATE)
+        dp.register_message_handler(self.dispatch_message, state=ANY_STATE)
+
+    # --------------------------------------------------------
+    # lookup
+    # --------------------------------------------------------
+    @staticmethod
+    def _lookup(index, st, key):
+        return [index.get((st, key)), index.get((ANY_STATE, key))]
+
+    @staticmethod
+    def _first(entries):
+        """Handler registered first among the matching (order, handler) entries."""
+        found = [e for e in entries if e is not None]
+        return min(found, key=lambda e: e[0])[1] if found else None
+
+    def resolve_callback(self, st, data):
+        entries = self._lookup(self._cb_exact, st, data)
+        cut = data.find('_')
+        if cut >= 0:
+            entries += self._lookup(self._cb_prefix, st, data[:cut + 1])
+        return self._first(entries)
+
+    def resolve_message(self, st, message):
+        entries = [self._states.get(st), self._states.get(ANY_STATE)]
+        if message.is_command():
+            entries += self._lookup(self._commands, st, message.get_command(pure=True).lower())
+        if message.text:
+            entries += self._lookup(self._texts, st, message.text.lower())
+        return self._first(entries)
+
+    async def _call(self, handler, obj, state):
+        if self.observer is None:
+            return await handler(obj, state)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await handler(obj, state)
+            failed = False
+            return result
+        finally:
+            self.observer(handler.__name__, time.perf_counter() - started, failed)
+
+    async def dispatch_callback(self, callback: types.CallbackQuery, state: FSMContext):
+        if not callback.data:
+            return
+        handler = self.resolve_callback(await state.get_state(), callback.data)
+        if handler is not None:
+            return await self._call(handler, callback, state)
+
+    async def dispatch_message(self, message: types.Message, state: FSMContext):
+        handler = self.resolve_message(await state.get_state(), message)
+        if handler is not None:
+            return await self._call(handler, message, state)
@@ -0,0 +1,276 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+# ============================================================
+# Token buckets
+# ============================================================
+class TokenBucket:
+    """Classic token bucket: rate tokens per second, up to capacity."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp', 'blocked_until')
+
+    def __init__(self, rate, capacity):
+        self.rate     = rate
+        self.capacity = capacity
+        self.tokens   = capacity
+        self.stamp    = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp  = now
+
+    def delay(self, now):
+        """Seconds until one token is available (0 if available now)."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+# ============================================================
+# Outbound send scheduler
+# ============================================================
+PRIORITY_USER  = 0   # ответы пользователям
+PRIORITY_GROUP = 1   # уведомления в группу менеджеров
+PRIORITY_BROADCAST = 2   # рассылки — только когда больше некому
+
+
+def is_group(chat_id):
+    return str(chat_id).startswith('-')
+
+
+class SendScheduler:
+    """
+    Central queue for outgoing Telegram messages.
+
+    Every send passes a global bucket (~30 msg/s) and a per-chat bucket
+    (private chats ~1 msg/s with a small burst, groups ~20 msg/min).
+    User replies go before group notifications, and both before
+    broadcasts; RetryAfter pauses the chat and the message is retried
+    automatically.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, group_per_min=20,
+                 report_interval=60):
+        self.chat_rate      = chat_rate
+        self.chat_burst     = chat_burst
+        self.group_per_min  = group_per_min
+        self.report_interval = report_interval
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats  = {}
+        self._queue  = None
+        self._task   = None
+        self._seq    = itertools.count()
+        self._deferred = {}      # handle call_later -> отложенное задание
+        self._inflight = set()   # задачи _send, ещё не получившие ответ
+        # счётчики для отчёта
+        self.sent        = 0
+        self.retry_after = 0
+        self.failed      = 0
+        self.wait_total  = 0.0
+        self.wait_max    = 0.0
+        self._reported   = time.monotonic()
+
+    def _bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10_000:
+                # выкидываем полностью восстановившиеся бакеты
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_idle(now)}
+            if is_group(chat_id):
+                bucket = TokenBucket(self.group_per_min / 60.0, self.group_per_min)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def share(self, fraction):
+        """Keep only a fraction of the global and group limits (one of N processes)."""
+        self._global = TokenBucket(self._global.rate * fraction, max(1, self._global.capacity * fraction))
+        self.group_per_min = max(1, self.group_per_min * fraction)
+
+    def stats(self):
+        sent = self.sent or 1
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'sent': self.sent,
+            'retry_after': self.retry_after,
+            'failed': self.failed,
+            'wait_avg': self.wait_total / sent,
+            'wait_max': self.wait_max,
+        }
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.PriorityQueue()
+            self._task  = asyncio.create_task(self._run())
+
+    async def close(self, timeout=10):
+        """
+        Give queued, deferred and in-flight messages up to timeout seconds,
+        then stop; futures of messages that were not sent are cancelled.
+        """
+        if self._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self._queue.qsize() or self._deferred) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self._task.cancel()
+        self._task = None
+        for handle, item in self._deferred.items():
+            handle.cancel()
+            item[2][4].cancel()
+        self._deferred.clear()
+        if self._inflight:
+            _, pending = await asyncio.wait(set(self._inflight), timeout=max(0.0, deadline - time.monotonic()))
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        # RetryAfter мог вернуть задания в очередь уже после остановки
+        while not self._queue.empty():
+            self._queue.get_nowait()[2][4].cancel()
+
+    def submit(self, chat_id, send, *args, priority=None, **kwargs):
+        """Queue send(*args, **kwargs) for chat_id; returns a future with its result."""
+        self.start()
+        if priority is None:
+            priority = PRIORITY_GROUP if is_group(chat_id) else PRIORITY_USER
+        fut = asyncio.get_running_loop().create_future()
+        job = (chat_id, send, args, kwargs, fut, time.monotonic())
+        self._queue.put_nowait((priority, next(self._seq), job))
+        return fut
+
+    def notify(self, chat_id, send, *args, **kwargs):
+        """Fire-and-forget submit; errors are only logged."""
+        fut = self.submit(chat_id, send, *args, **kwargs)
+        fut.add_done_callback(self._log_failure)
+        return fut
+
+    @staticmethod
+    def _log_failure(fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            logging.error(f"Не удалось отправить уведомление: {fut.exception()}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            priority, seq, job = item
+            now = time.monotonic()
+            bucket = self._bucket(job[0], now)
+            wait = bucket.delay(now)
+            if wait > 0:
+                # чат ещё на лимите — вернём задание в очередь позже, остальных не держим
+                self._defer(loop, wait, item)
+                continue
+            wait = self._global.delay(now)
+            if wait > 0:
+                try:
+                    await asyncio.sleep(wait)
+                except asyncio.CancelledError:
+                    job[4].cancel()
+                    raise
+                now = time.monotonic()
+            self._global.consume(now)
+            bucket.consume(now)
+            task = loop.create_task(self._send(item, bucket))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+            self._report(now)
+
+    def _defer(self, loop, wait, item):
+        def requeue():
+            del self._deferred[handle]
+            self._queue.put_nowait(item)
+        handle = loop.call_later(wait, requeue)
+        self._deferred[handle] = item
+
+    async def _send(self, item, bucket):
+        priority, seq, job = item
+        chat_id, send, args, kwargs, fut, queued = job
+        if fut.done():
+            return
+        try:
+            result = await send(*args, **kwargs)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except RetryAfter as e:
+            self.retry_after += 1
+            bucket.blocked_until = time.monotonic() + e.timeout
+            logging.warning(f"Telegram RetryAfter {e.timeout}s для чата {chat_id}")
+            self._queue.put_nowait(item)
+            return
+        except Exception as e:
+            self.failed += 1
+            # ожидающий мог уже отменить future — тогда результат никому не нужен
+            if not fut.done():
+                fut.set_exception(e)
+            return
+        waited = time.monotonic() - queued
+        self.sent += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        if not fut.done():
+            fut.set_result(result)
+
+    def _report(self, now):
+        if now - self._reported < self.report_interval:
+            return
+        self._reported = now
+        s = self.stats()
+        logging.info(
+            f"Sender: очередь {s['queue_depth']}, отправлено {s['sent']}, "
+            f"ожидание ср {s['wait_avg']:.2f}s / макс {s['wait_max']:.2f}s, "
+            f"RetryAfter {s['retry_after']}, ошибок {s['failed']}"
+        )
+
+
+class ScheduledBot(Bot):
+    """Bot whose send_message (and so message.answer) and send_document go through SendScheduler."""
+
+    def __init__(self, *args, scheduler: SendScheduler, observer=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+        # observer(method, seconds, failed) — после каждого вызова Bot API
+        self.observer  = observer
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if self.observer is None:
+            return await super().request(method, data, files, **kwargs)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await super().request(method, data, files, **kwargs)
+            failed = False
+            return result
+        finally:
+            self.observer(method, time.perf_counter() - started, failed)
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        return await self.scheduler.submit(chat_id, super().send_message, chat_id, text, *args, **kwargs)
+
+    async def send_document(self, chat_id, document, *args, **kwargs):
+        return await self.scheduler.submit(chat_id, super().send_document, chat_id, document, *args, **kwargs)
+
+    async def send_broadcast(self, chat_id, text, *args, **kwargs):
+        """Campaign message: queued behind user replies and group notifications."""
+        return await self.scheduler.submit(chat_id, super().send_message, chat_id, text, *args,
+                                           priority=PRIORITY_BROADCAST, **kwargs)
+
+    def notify(self, chat_id, text, *args, **kwargs):
+        """Queue a low-priority message without waiting for it."""
+        return self.scheduler.notify(chat_id, super().send_message, chat_id, text, *args,
+                                     priority=PRIORITY_GROUP, **kwargs)
@@ -0,0 +1,371 @@
+import asyncio
+import functools
+import logging
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import gspread
+import requests
+from google.auth.transport.requests import AuthorizedSession, Request
+
+# ============================================================
+# Write-behind queue for Google Sheets
+# ============================================================
+# коды, при которых Google просит повторить запрос позже
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+
+def is_retryable(exc):
+    """True if the Sheets error is a quota/transient one worth retrying."""
+    if isinstance(exc, gspread.exceptions.APIError):
+        status = getattr(exc.response, 'status_code', None)
+        return status in RETRYABLE_STATUS
+    return isinstance(exc, (ConnectionError, TimeoutError,
+                            requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout))
+
+
+def may_have_landed(exc):
+    """
+    True if the request timed out after it was sent: Google may have applied
+    it, so an append must not be repeated blindly.
+    """
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return False
+    return isinstance(exc, (TimeoutError, asyncio.TimeoutError, requests.exceptions.Timeout))
+
+
+def appended_row(response):
+    """Sheet row number of the first row in an append_rows response, or None."""
+    try:
+        updated = response['updates']['updatedRange']
+    except (TypeError, KeyError):
+        return None
+    # вида "'Лист1'!A12:F14"
+    m = re.search(r'![A-Z]+(\d+)', updated)
+    return int(m.group(1)) if m else None
+
+
+# ============================================================
+# Lazy spreadsheet / worksheet handles
+# ============================================================
+class LazySpreadsheet:
+    """
+    Opens the gspread client, spreadsheet and worksheets on first use and
+    caches them, so the bot can boot while Google is unreachable.
+    Methods are blocking: call them through SheetsExecutor.
+    """
+
+    def __init__(self, client_factory, key):
+        self.key = key
+        self.client_factory = client_factory
+        self._lock        = threading.Lock()
+        self._client      = None
+        self._spreadsheet = None
+        self._specs       = {}
+        self._worksheets  = {}
+
+    def define(self, name, title, header=None, rows=1000, cols=26):
+        """Declare a worksheet; it is created with header if missing."""
+        self._specs[name] = (title, header, rows, cols)
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self.client_factory()
+            return self._client
+
+    def spreadsheet(self):
+        client = self.client()
+        with self._lock:
+            if self._spreadsheet is None:
+                self._spreadsheet = client.open_by_key(self.key)
+            return self._spreadsheet
+
+    def worksheet(self, name):
+        ws = self._worksheets.get(name)
+        if ws is not None:
+            return ws
+        sh = self.spreadsheet()
+        title, header, rows, cols = self._specs[name]
+        with self._lock:
+            if name not in self._worksheets:
+                try:
+                    ws = sh.worksheet(title)
+                except gspread.exceptions.WorksheetNotFound:
+                    ws = sh.add_worksheet(title=title, rows=rows, cols=cols)
+                    if header:
+                        ws.append_row(header)
+                self._worksheets[name] = ws
+                logging.info(f"Sheets: открыт лист '{title}'")
+            return self._worksheets[name]
+
+
+# ============================================================
+# Shared keep-alive session and background token refresh
+# ============================================================
+class GoogleSession:
+    """
+    One AuthorizedSession with a keep-alive connection pool of pool_size
+    for every gspread call, created on first use from load_credentials()
+    (google-auth credentials). start() refreshes the access token in the
+    background refresh_margin seconds before it expires, so no Sheets call
+    waits for a token refresh or a new TLS handshake to Google.
+    """
+
+    def __init__(self, load_credentials, pool_size=4, timeout=20.0, refresh_margin=600):
+        self.load_credentials = load_credentials
+        self.pool_size      = pool_size
+        self.timeout        = timeout
+        self.refresh_margin = refresh_margin
+        self.credentials    = None
+        self.session        = None
+        self.refreshes      = 0
+        self._auth_request = None
+        self._lock = threading.Lock()
+        self._task = None
+
+    def _open(self):
+        with self._lock:
+            if self.session is None:
+                credentials = self.load_credentials()
+                # токен обновляется тоже через одно keep-alive соединение
+                self._auth_request = Request(requests.Session())
+                session = AuthorizedSession(credentials, auth_request=self._auth_request)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                self.credentials, self.session = credentials, session
+            return self.session
+
+    def client(self):
+        """gspread client on the shared session; blocking, call in the executor."""
+        gc = gspread.Client(auth=None, session=self._open())
+        # чтобы зависший запрос к Google не держал поток пула вечно
+        gc.set_timeout(self.timeout)
+        return gc
+
+    def refresh(self):
+        """Fetch a new access token; blocking, call in the executor."""
+        self._open()
+        started = time.perf_counter()
+        self.credentials.refresh(self._auth_request)
+        self.refreshes += 1
+        s = self.stats()
+        logging.info(
+            f"Google: токен обновлён за {time.perf_counter() - started:.2f}s, "
+            f"действует ещё {s['token_ttl']:.0f}s; соединений {s['connections']} на {s['requests']} запросов"
+        )
+
+    def token_ttl(self):
+        """Seconds until the access token expires (0 if there is none)."""
+        expiry = self.credentials.expiry if self.credentials is not None else None
+        if expiry is None or not self.credentials.token:
+            return 0.0
+        if expiry.tzinfo is None:
+            expiry = expiry.replace(tzinfo=timezone.utc)
+        return max(0.0, (expiry - datetime.now(timezone.utc)).total_seconds())
+
+    def stats(self):
+        """Opened connections and requests sent over the pool, token state."""
+        connections = requests_sent = 0
+        if self.session is not None:
+            pools = self.session.get_adapter('https://').poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    connections   += pool.num_connections
+                    requests_sent += pool.num_requests
+        return {'connections': connections, 'requests': requests_sent,
+                'token_refreshes': self.refreshes, 'token_ttl': self.token_ttl()}
+
+    def start(self, executor):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(executor))
+
+    async def _run(self, executor):
+        while True:
+            if self.session is None:
+                # сессия создаётся первым обращением к таблице
+                await asyncio.sleep(30)
+                continue
+            await asyncio.sleep(max(0.0, self.token_ttl() - self.refresh_margin))
+            try:
+                await executor.run(self.refresh)
+            except Exception as e:
+                logging.error(f"Google: не удалось обновить токен: {e}")
+                await asyncio.sleep(30)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.session is not None:
+            self.session.close()
+
+
+# ============================================================
+# Bounded executor for blocking gspread calls
+# ============================================================
+class SheetsExecutor:
+    """
+    Runs synchronous gspread calls in a small thread pool so they never
+    block the event loop. At most max_workers calls are in flight, each
+    limited by timeout seconds. observer(call_name, seconds, failed) is
+    called after every call.
+    """
+
+    def __init__(self, max_workers=4, timeout=20.0, observer=None):
+        self.timeout  = timeout
+        self.observer = observer
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sheets')
+        self._sem  = asyncio.Semaphore(max_workers)
+
+    async def run(self, fn, *args, timeout=None, **kwargs):
+        async with self._sem:
+            loop = asyncio.get_running_loop()
+            fut = loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+            if self.observer is None:
+                return await asyncio.wait_for(fut, timeout or self.timeout)
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = await asyncio.wait_for(fut, timeout or self.timeout)
+                failed = False
+                return result
+            finally:
+                self.observer(fn.__name__.lstrip('_'), time.perf_counter() - started, failed)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+class SheetWriter:
+    """
+    Collects rows per worksheet and flushes them with one append_rows call.
+    Flush happens when a worksheet has batch_size rows pending or
+    flush_interval seconds passed, whichever comes first.
+    on_written(name, first_row, rows) is called after every written batch;
+    first_row is the sheet row of rows[0] (None if Google did not say).
+    Quota and connection errors are retried with backoff; a batch that
+    timed out is not, since it may already be in the sheet, and its
+    on_failed callbacks fire instead.
+    """
+
+    def __init__(self, executor=None, batch_size=50, flush_interval=2.0, max_retries=6,
+                 backoff_base=1.0, backoff_max=60.0, on_written=None):
+        self.executor       = executor or SheetsExecutor()
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries    = max_retries
+        self.backoff_base   = backoff_base
+        self.backoff_max    = backoff_max
+        self.on_written     = on_written
+        self._worksheets = {}
+        self._pending    = {}
+        self._wakeup     = None
+        self._task       = None
+        self._closing    = False
+
+    def register(self, name, open_worksheet):
+        """open_worksheet() returns the gspread worksheet; called in the executor."""
+        self._worksheets[name] = open_worksheet
+        self._pending.setdefault(name, [])
+
+    def enqueue(self, name, row, on_done=None, on_failed=None):
+        """
+        Queue a row for the worksheet; never blocks, never raises on I/O.
+        on_done() is called once the row is actually written, on_failed()
+        if its batch was dropped.
+        """
+        pending = self._pending[name]
+        pending.append((row, on_done, on_failed))
+        if len(pending) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending(self):
+        return sum(len(rows) for rows in self._pending.values())
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the background task and drain everything that is still queued."""
+        self._closing = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        while self.pending():
+            if not await self.flush():
+                break
+        left = self.pending()
+        if left:
+            logging.error(f"Sheets: при остановке не записано строк: {left}")
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Sheets: ошибка фоновой записи: {e}")
+
+    async def flush(self):
+        """Flush every worksheet once. Returns False if some rows were dropped."""
+        ok = True
+        for name in list(self._pending):
+            while self._pending[name]:
+                if not await self._flush_one(name):
+                    ok = False
+                    break
+        return ok
+
+    def _append_rows(self, name, rows):
+        return self._worksheets[name]().append_rows(rows)
+
+    async def _flush_one(self, name):
+        pending = self._pending[name]
+        batch = pending[:self.batch_size]
+        rows = [row for row, _, _ in batch]
+        attempt = 0
+        while True:
+            try:
+                response = await self.executor.run(self._append_rows, name, rows)
+                break
+            except Exception as e:
+                if not is_retryable(e) or may_have_landed(e) or attempt >= self.max_retries:
+                    # после таймаута строки могли записаться — повтор решает владелец строк
+                    # через on_failed, сверившись с таблицей
+                    logging.error(f"Sheets: не удалось записать {len(rows)} строк в '{name}': {e}")
+                    del pending[:len(rows)]
+                    for _, _, on_failed in batch:
+                        if on_failed is not None:
+                            on_failed()
+                    return False
+                delay = min(self.backoff_base * 2 ** attempt, self.backoff_max)
+                delay += random.uniform(0, delay / 2)
+                logging.warning(f"Sheets: лимит/ошибка '{name}' ({e}), повтор через {delay:.1f}s")
+                attempt += 1
+                await asyncio.sleep(delay)
+        del pending[:len(rows)]
+        logging.debug(f"Sheets: записано {len(rows)} строк в '{name}'")
+        if self.on_written is not None:
+            try:
+                self.on_written(name, appended_row(response), rows)
+            except Exception as e:
+                logging.error(f"Sheets: ошибка on_written для '{name}': {e}")
+        for _, on_done, _ in batch:
+            if on_done is not None:
+                on_done()
+        return True
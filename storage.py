@@ -0,0 +1,394 @@
+import asyncio
+import copy
+import json
+import sqlite3
+import time
+import typing
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+
+# ============================================================
+# SQLite FSM storage
+# ============================================================
+class SQLiteStorage(BaseStorage):
+    """
+    File-backed FSM storage (SQLite in WAL mode).
+
+    Records are loaded lazily per chat/user and kept in memory; changes are
+    written behind in one transaction every flush_interval seconds, so the
+    several update_data/set_state calls of one handler cost a single write.
+    At most max_cached clean records stay in memory (least recently used go
+    first), and rows not written for ttl seconds are deleted every
+    prune_interval seconds, like the memory storage forgets abandoned
+    sessions. Each chat must be served by one process at a time.
+    """
+
+    def __init__(self, path='fsm.sqlite3', flush_interval=0.5, ttl=24 * 3600,
+                 max_cached=10_000, prune_interval=600, count_interval=30):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.max_cached = max_cached
+        self.prune_interval = prune_interval
+        self.count_interval = count_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS fsm ('
+            ' chat TEXT NOT NULL, user TEXT NOT NULL,'
+            ' state TEXT, data TEXT NOT NULL, bucket TEXT NOT NULL, touched REAL,'
+            ' PRIMARY KEY (chat, user))'
+        )
+        # файлы, созданные до колонки touched
+        cols = [row[1] for row in self._db.execute('PRAGMA table_info(fsm)')]
+        if 'touched' not in cols:
+            self._db.execute('ALTER TABLE fsm ADD COLUMN touched REAL')
+        self._db.execute('UPDATE fsm SET touched = ? WHERE touched IS NULL', (time.time(),))
+        self._db.execute('CREATE INDEX IF NOT EXISTS fsm_touched ON fsm (touched)')
+        self._db.commit()
+        self._cache = OrderedDict()   # порядок — последнее обращение, старые в начале
+        self._dirty = set()
+        self._flush_handle = None
+        self._pruned = time.monotonic()
+        self._counts  = None
+        self._counted = 0.0
+        self.evicted = 0
+        self.expired = 0
+
+    # --------------------------------------------------------
+    # cache / write-behind
+    # --------------------------------------------------------
+    def _record(self, chat, user):
+        key = tuple(map(str, self.check_address(chat=chat, user=user)))
+        rec = self._cache.get(key)
+        if rec is None:
+            row = self._db.execute(
+                'SELECT state, data, bucket, touched FROM fsm WHERE chat = ? AND user = ?', key
+            ).fetchone()
+            if row:
+                rec = {'state': row[0], 'data': json.loads(row[1]), 'bucket': json.loads(row[2]),
+                       'touched': row[3]}
+            else:
+                rec = {'state': None, 'data': {}, 'bucket': {}, 'touched': time.time()}
+            self._cache[key] = rec
+            self._evict(keep=key)
+        else:
+            self._cache.move_to_end(key)
+        return key, rec
+
+    def _evict(self, keep=None):
+        # из памяти уходят только записанные записи; изменённые ждут flush.
+        # Идём от давно не использованных и берём первую чистую — список ключей не копируем
+        cache = self._cache
+        while len(cache) > self.max_cached:
+            for key in cache:
+                if key != keep and key not in self._dirty:
+                    break
+            else:
+                return
+            del cache[key]
+            self.evicted += 1
+
+    def _touch(self, key):
+        self._dirty.add(key)
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Write every changed record in one transaction."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if time.monotonic() - self._pruned >= self.prune_interval:
+            self.prune()
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        now = time.time()
+        upserts, deletes = [], []
+        for key in dirty:
+            rec = self._cache.get(key)
+            if rec is None:
+                continue
+            if rec['state'] is None and not rec['data'] and not rec['bucket']:
+                # пустая запись — диалог завершён, место не держим
+                deletes.append(key)
+                del self._cache[key]
+            else:
+                rec['touched'] = now
+                upserts.append((*key, rec['state'], json.dumps(rec['data']), json.dumps(rec['bucket']), now))
+        with self._db:
+            if deletes:
+                self._db.executemany('DELETE FROM fsm WHERE chat = ? AND user = ?', deletes)
+            if upserts:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO fsm (chat, user, state, data, bucket, touched) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    upserts
+                )
+        self._evict()
+
+    def prune(self):
+        """Delete sessions not written for ttl seconds, on disk and in memory."""
+        self._pruned = time.monotonic()
+        cutoff = time.time() - self.ttl
+        for key, rec in list(self._cache.items()):
+            if key not in self._dirty and rec['touched'] < cutoff:
+                del self._cache[key]
+        with self._db:
+            n = self._db.execute('DELETE FROM fsm WHERE touched < ?', (cutoff,)).rowcount
+        self.expired += n
+        return n
+
+    def stats(self):
+        """Records held in memory, evicted from memory, and expired rows deleted."""
+        return {'live': len(self._cache), 'evicted': self.evicted, 'expired': self.expired}
+
+    def states_count(self):
+        """
+        Number of stored sessions per FSM state, recounted at most every
+        count_interval seconds. Reads committed rows only: the write-behind
+        buffer is not flushed for a metrics scrape.
+        """
+        now = time.monotonic()
+        if self._counts is None or now - self._counted >= self.count_interval:
+            rows = self._db.execute('SELECT state, COUNT(*) FROM fsm GROUP BY state').fetchall()
+            self._counts = {state or 'none': n for state, n in rows}
+            self._counted = now
+        return self._counts
+
+    async def close(self):
+        self.flush()
+        self._db.close()
+
+    async def wait_closed(self):
+        pass
+
+    # --------------------------------------------------------
+    # BaseStorage interface
+    # --------------------------------------------------------
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, rec = self._record(chat, user)
+        return rec['state'] if rec['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, rec = self._record(chat, user)
+        return copy.deepcopy(rec['data'])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, rec = self._record(chat, user)
+        rec['state'] = self.resolve_state(state)
+        self._touch(key)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, rec = self._record(chat, user)
+        rec['data'] = copy.deepcopy(data or {})
+        self._touch(key)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key, rec = self._record(chat, user)
+        rec['data'].update(data or {}, **kwargs)
+        self._touch(key)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, rec = self._record(chat, user)
+        return copy.deepcopy(rec['bucket'])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, rec = self._record(chat, user)
+        rec['bucket'] = copy.deepcopy(bucket or {})
+        self._touch(key)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key, rec = self._record(chat, user)
+        rec['bucket'].update(bucket or {}, **kwargs)
+        self._touch(key)
+
+
+# ============================================================
+# Bounded in-memory FSM storage
+# ============================================================
+class _Session:
+    __slots__ = ('state', 'data', 'bucket', 'touched')
+
+    def __init__(self):
+        self.state   = None
+        self.data    = None
+        self.bucket  = None
+        self.touched = 0.0
+
+    def is_empty(self):
+        return self.state is None and not self.data and not self.bucket
+
+
+class BoundedMemoryStorage(BaseStorage):
+    """
+    In-memory FSM storage that forgets abandoned sessions.
+
+    Sessions idle longer than ttl seconds expire, and when more than
+    max_entries are alive the least recently used one is evicted, so memory
+    stays flat no matter how many users press /start and leave.
+    """
+
+    def __init__(self, ttl=24 * 3600, max_entries=50_000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self.evicted = 0
+        self.expired = 0
+
+    def stats(self):
+        return {'live': len(self._sessions), 'evicted': self.evicted, 'expired': self.expired}
+
+    def states_count(self):
+        """Number of live sessions per FSM state."""
+        counts = {}
+        for sess in self._sessions.values():
+            key = sess.state or 'none'
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def _expire(self, now):
+        # OrderedDict упорядочен по последнему обращению — старые в начале
+        sessions = self._sessions
+        while sessions:
+            key, sess = next(iter(sessions.items()))
+            if now - sess.touched < self.ttl:
+                break
+            del sessions[key]
+            self.expired += 1
+
+    def _get(self, chat, user):
+        """Existing session or None, without creating one."""
+        key = self.check_address(chat=chat, user=user)
+        sess = self._sessions.get(key)
+        if sess is not None and time.monotonic() - sess.touched >= self.ttl:
+            del self._sessions[key]
+            self.expired += 1
+            return None
+        return sess
+
+    def _session(self, chat, user):
+        key = self.check_address(chat=chat, user=user)
+        now = time.monotonic()
+        self._expire(now)
+        sess = self._sessions.get(key)
+        if sess is None:
+            sess = self._sessions[key] = _Session()
+            if len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._sessions.move_to_end(key)
+        sess.touched = now
+        return key, sess
+
+    def _cleanup(self, key, sess):
+        if sess.is_empty():
+            self._sessions.pop(key, None)
+
+    async def close(self):
+        self._sessions.clear()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        sess = self._get(chat, user)
+        if sess is None or sess.state is None:
+            return self.resolve_state(default)
+        return sess.state
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        sess = self._get(chat, user)
+        return copy.deepcopy(sess.data) if sess is not None and sess.data else {}
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, sess = self._session(chat, user)
+        sess.state = self.resolve_state(state)
+        self._cleanup(key, sess)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, sess = self._session(chat, user)
+        sess.data = copy.deepcopy(data) or None
+        self._cleanup(key, sess)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key, sess = self._session(chat, user)
+        if sess.data is None:
+            sess.data = {}
+        sess.data.update(data or {}, **kwargs)
+        self._cleanup(key, sess)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        sess = self._get(chat, user)
+        return copy.deepcopy(sess.bucket) if sess is not None and sess.bucket else {}
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, sess = self._session(chat, user)
+        sess.bucket = copy.deepcopy(bucket) or None
+        self._cleanup(key, sess)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key, sess = self._session(chat, user)
+        if sess.bucket is None:
+            sess.bucket = {}
+        sess.bucket.update(bucket or {}, **kwargs)
+        self._cleanup(key, sess)
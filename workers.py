@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import itertools
+import multiprocessing
+import queue as queue_module
+import signal
+import time
+from collections import OrderedDict, deque
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+from metrics import merge, render
+
+# ============================================================
+# Multi-process webhook serving
+# ============================================================
+# где в апдейте искать чат, по которому держим порядок
+_CHAT_PATHS = (
+    ('message', 'chat'),
+    ('edited_message', 'chat'),
+    ('callback_query', 'message', 'chat'),
+    ('callback_query', 'from'),
+    ('my_chat_member', 'chat'),
+    ('chat_member', 'chat'),
+    ('chat_join_request', 'chat'),
+    ('channel_post', 'chat'),
+    ('inline_query', 'from'),
+    ('pre_checkout_query', 'from'),
+)
+
+
+def update_chat_id(update):
+    """Chat (or user) id an update belongs to; 0 if there is none."""
+    for path in _CHAT_PATHS:
+        node = update
+        for key in path:
+            node = node.get(key) if isinstance(node, dict) else None
+            if node is None:
+                break
+        if node is not None:
+            return node.get('id', 0)
+    return 0
+
+
+class ChatSerializer:
+    """Runs jobs of one chat strictly one after another, different chats in parallel."""
+
+    def __init__(self):
+        self._tails = {}
+
+    def submit(self, key, job):
+        prev = self._tails.get(key)
+
+        async def run():
+            if prev is not None:
+                await asyncio.wait([prev])
+            try:
+                await job()
+            except Exception as e:
+                logging.exception(f"Ошибка обработки апдейта для чата {key}: {e}")
+            finally:
+                if self._tails.get(key) is task:
+                    del self._tails[key]
+
+        task = asyncio.create_task(run())
+        self._tails[key] = task
+        return task
+
+    async def join(self):
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+
+async def _push_metrics(index, stats_queue, snapshot, interval):
+    while True:
+        await asyncio.sleep(interval)
+        stats_queue.put(('metrics', index, snapshot()))
+
+
+async def run_worker(queue, dp, on_startup, on_shutdown,
+                     index=0, stats_queue=None, snapshot=None, interval=5):
+    """
+    Worker loop: take (seq, update) pairs from the front process and feed
+    the updates to dp. Every taken seq is reported back on stats_queue, so
+    the front knows what is still waiting in the queue; every interval
+    seconds snapshot() is sent there too, for /metrics.
+    """
+    # Ctrl+C получает вся группа процессов — останавливает нас фронт
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.get_running_loop()
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    serializer = ChatSerializer()
+    await on_startup()
+    pusher = None
+    if stats_queue is not None and snapshot is not None:
+        pusher = asyncio.create_task(_push_metrics(index, stats_queue, snapshot, interval))
+    while True:
+        item = await loop.run_in_executor(None, queue.get)
+        if item is None:
+            break
+        seq, data = item
+        if stats_queue is not None:
+            stats_queue.put(('taken', seq))
+        # через updates_handler, а не process_update — иначе не сработают update-middleware
+        serializer.submit(update_chat_id(data), lambda d=data: dp.updates_handler.notify(types.Update(**d)))
+    await serializer.join()
+    if pusher is not None:
+        pusher.cancel()
+    await on_shutdown()
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    session = await dp.bot.get_session()
+    await session.close()
+
+
+def serve(workers, worker_target, webhook_path, host, port, on_startup, on_shutdown,
+          metrics_path='/metrics', max_restarts=5, restart_window=60):
+    """
+    Front process: accepts webhook POSTs and routes each update to one of
+    `workers` processes by chat id, so every chat is handled by the same
+    worker in order. on_startup/on_shutdown (set/delete webhook) run once
+    here; worker_target(index, workers, queue, stats_queue) runs in each
+    worker. metrics_path serves the merged metrics snapshots of all workers.
+
+    Updates a worker has not taken yet stay in the front (backlog). A
+    worker that dies is restarted with fresh queues and gets its backlog
+    again: a killed process may hold the lock of its old queue forever.
+    More than max_restarts deaths of one worker within restart_window
+    seconds stop the front.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    seqs = itertools.count()
+    backlog = [OrderedDict() for _ in range(workers)]   # seq -> апдейт, ещё не взятый воркером
+    snapshots = {}
+    procs, queues, collectors = [None] * workers, [None] * workers, [None] * workers
+    failed = []
+
+    def spawn(i):
+        queues[i] = ctx.Queue()
+        stats_queue = ctx.Queue()
+        procs[i] = ctx.Process(target=worker_target, args=(i, workers, queues[i], stats_queue),
+                               name=f"bot-worker-{i}")
+        procs[i].start()
+        # всё, что прежний процесс не успел взять, — в новую очередь, в том же порядке
+        for item in backlog[i].items():
+            queues[i].put(item)
+        collectors[i] = asyncio.get_event_loop().create_task(collect(i, procs[i], stats_queue))
+
+    async def handle(request):
+        update = await request.json()
+        i = update_chat_id(update) % workers
+        seq = next(seqs)
+        backlog[i][seq] = update
+        queues[i].put((seq, update))
+        return web.Response()
+
+    async def metrics_view(request):
+        return web.Response(text=render(merge(snapshots)), content_type='text/plain')
+
+    async def collect(i, proc, stats_queue):
+        # отметки «взято» и метрики одного процесса; заканчивается вместе с ним
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                item = await loop.run_in_executor(None, stats_queue.get, True, 1.0)
+            except queue_module.Empty:
+                if procs[i] is not proc or not proc.is_alive():
+                    break
+                continue
+            if item[0] == 'taken':
+                backlog[i].pop(item[1], None)
+            else:
+                _, index, snap = item
+                snapshots[index] = snap
+
+    async def supervise():
+        deaths = [deque() for _ in range(workers)]
+        while True:
+            await asyncio.sleep(1)
+            for i, p in enumerate(procs):
+                if p.is_alive():
+                    continue
+                now = time.monotonic()
+                deaths[i].append(now)
+                while now - deaths[i][0] > restart_window:
+                    deaths[i].popleft()
+                if len(deaths[i]) > max_restarts:
+                    logging.critical(f"{p.name} падает снова и снова (код {p.exitcode}), останавливаем фронт")
+                    failed.append(p.name)
+                    # тот же путь, что Ctrl+C/SIGTERM: run_app выполнит cleanup
+                    signal.raise_signal(signal.SIGTERM)
+                    return
+                # дочитываем отметки «взято» погибшего процесса, чтобы не отдать апдейты дважды
+                try:
+                    await asyncio.wait_for(collectors[i], 5)
+                except asyncio.TimeoutError:
+                    pass
+                logging.error(f"{p.name} завершился с кодом {p.exitcode}, перезапускаем "
+                              f"(в очереди {len(backlog[i])})")
+                spawn(i)
+
+    async def startup(app):
+        for i in range(workers):
+            spawn(i)
+        logging.info(f"Запущено воркеров: {workers}")
+        app['supervisor'] = asyncio.create_task(supervise())
+        await on_startup()
+
+    async def cleanup(app):
+        app['supervisor'].cancel()
+        await on_shutdown()
+        for q in queues:
+            q.put(None)
+        loop = asyncio.get_running_loop()
+        for p in procs:
+            await loop.run_in_executor(None, p.join, 60)
+            if p.is_alive():
+                logging.error(f"{p.name} не остановился, завершаем")
+                p.terminate()
+
+    app = web.Application()
+    app.router.add_post(webhook_path, handle)
+    app.router.add_get(metrics_path, metrics_view)
+    app.on_startup.append(startup)
+    app.on_cleanup.append(cleanup)
+    web.run_app(app, host=host, port=port)
+    if failed:
+        # ненулевой код — чтобы оркестратор перезапустил контейнер целиком
+        raise SystemExit(1)